@@ -0,0 +1,273 @@
+import asyncio
+import os
+from threading import Lock, Thread
+
+from flask import current_app
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from api.client import (ExabeamClient, MAX_DAYS_AMOUNT, INVALID_CREDENTIALS,
+                        search_cache, indices_cache)
+from api.errors import (
+    AuthorizationError,
+    CriticalExabeamResponseError,
+    ExabeamConnectionError,
+    ExabeamSSLError
+)
+from api.json_provider import dumps, loads
+from api.metrics import observe_exabeam_response, span
+
+_loop = None
+_loop_pid = None
+_loop_lock = Lock()
+
+# Sessions and semaphores per Exabeam host and tasks of requests
+# in flight, used only from the event loop of the process.
+_sessions = {}
+_host_semaphores = {}
+_requests_in_flight = {}
+
+
+def async_client_enabled():
+    return bool(current_app.config['EXABEAM_ASYNC_CLIENT'] and aiohttp)
+
+
+def _event_loop():
+    global _loop, _loop_pid
+
+    with _loop_lock:
+        # The loop thread isn't carried over to forked processes.
+        if _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            _sessions.clear()
+            _host_semaphores.clear()
+            _requests_in_flight.clear()
+            Thread(target=_loop.run_forever, daemon=True).start()
+        return _loop
+
+
+def run(coroutine):
+    """
+    Run the coroutine on the event loop shared by all the threads of the
+    process and wait for its result. The coroutine runs in the context
+    of the calling thread, so current_app and flask.g are available.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop()).result()
+
+
+class _Response:
+    """Response of aiohttp with the attributes of a requests response."""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(errors='replace')
+
+
+class AsyncExabeamClient(ExabeamClient):
+    """
+    ExabeamClient whose requests are made with aiohttp on the event loop
+    of the process, so that its threads share one connection pool and
+    up to EXABEAM_ASYNC_MAX_CONCURRENT_REQUESTS requests are in flight.
+
+    health, get_data, get_data_many, get_indices and get_visualize_data
+    are coroutines to be awaited on that loop, see run.
+    Observables are searched separately, all at once,
+    so search batches and two-phase searches aren't used.
+    """
+
+    def __init__(self, context, refresh_cache=False):
+        super().__init__(context, refresh_cache)
+        self._max_concurrent_requests = current_app.config[
+            'EXABEAM_ASYNC_MAX_CONCURRENT_REQUESTS']
+        self._two_phase_search = False
+
+    async def health(self):
+        return await self._request(path='api/auth/check')
+
+    def _session(self):
+        session = _sessions.get(self._host)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._max_concurrent_requests
+            )
+            session = _sessions[self._host] = aiohttp.ClientSession(
+                connector=connector,
+                # Sessions are shared between credentials,
+                # so no cookies may be carried from one request to another.
+                cookie_jar=aiohttp.DummyCookieJar(),
+                json_serialize=lambda obj: dumps(obj).decode()
+            )
+            _host_semaphores[self._host] = asyncio.Semaphore(
+                self._max_concurrent_requests
+            )
+        return session, _host_semaphores[self._host]
+
+    async def _request(self, path, method='GET', body=None,
+                       params=None, data_extractor=lambda r: loads(r.content)):
+        if not self._request_coalescing:
+            return await self._send(path, method, body, params,
+                                    data_extractor)
+
+        key = (*self.fingerprint, method, path, dumps(body), dumps(params),
+               getattr(data_extractor, '__func__', data_extractor))
+        task = _requests_in_flight.get(key)
+        if task is None:
+            task = _requests_in_flight[key] = asyncio.ensure_future(
+                self._send(path, method, body, params, data_extractor)
+            )
+            task.add_done_callback(
+                lambda _: _requests_in_flight.pop(key, None)
+            )
+            return await task
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task),
+                                          self._coalescing_timeout)
+        except asyncio.TimeoutError:
+            return await self._send(path, method, body, params,
+                                    data_extractor)
+
+    async def _send(self, path, method, body, params, data_extractor):
+        url = '/'.join([self._url, path])
+        session, semaphore = self._session()
+
+        try:
+            async with semaphore:
+                with span('exabeam', self._timings) as request_span:
+                    async with session.request(
+                            method, url, json=body, params=params,
+                            headers=self._headers) as response:
+                        response = _Response(response.status,
+                                             await response.read())
+        except aiohttp.ClientConnectorCertificateError as error:
+            raise ExabeamSSLError(error)
+        except (aiohttp.ClientConnectionError, aiohttp.InvalidURL):
+            raise ExabeamConnectionError(self._url)
+        except (UnicodeEncodeError, ValueError):
+            # Raised for keys which can't be sent in a header.
+            raise AuthorizationError(INVALID_CREDENTIALS)
+
+        observe_exabeam_response(path, request_span.duration,
+                                 len(response.content))
+        if response.ok:
+            return data_extractor(response)
+
+        raise CriticalExabeamResponseError(response)
+
+    async def _search_hits(self, query, size, indices=None):
+        if indices is None:
+            indices = await self.get_indices(MAX_DAYS_AMOUNT)
+        if self._is_sharded(indices):
+            return await self._search_sharded(query, size, indices)
+        return await self._search_request(indices, query, size)
+
+    async def _search_request(self, indices, query, size):
+        return await self._request(
+            path='dl/api/es/search',
+            method='POST',
+            body=self._get_payload(indices, query, size, self._source),
+            data_extractor=self._extract_hits
+        )
+
+    async def _search_sharded(self, query, size, indices):
+        ranges_hits = await asyncio.gather(*(
+            self._search_request(range_, query, size)
+            for range_ in self._shard_ranges(indices)
+        ))
+        return self._merge_hits(ranges_hits, size)
+
+    async def _search(self, observable, size=None):
+        query = self._query(observable)
+        size = size or self._search_size
+        if not self._progressive_search_windows:
+            return await self._search_hits(query, size)
+
+        hits = []
+        indices = await self.get_indices(MAX_DAYS_AMOUNT)
+        for window in self._search_windows(indices):
+            if len(hits) >= size:
+                break
+            hits.extend(await self._search_hits(query, size - len(hits),
+                                                window))
+        return hits
+
+    async def _search_cached(self, observable):
+        cache_key = self._search_cache_key(observable)
+        if not self._refresh_cache:
+            result = search_cache.get(cache_key)
+            if result is not None:
+                return result
+
+        hits = self._cap_messages(await self._search(observable))
+        result = (hits, len(hits))
+        search_cache.set(cache_key, result,
+                         self._search_cache_ttl if hits
+                         else self._search_negative_cache_ttl)
+        return result
+
+    async def get_data(self, observable):
+        observable = (observable['type'], observable['value'])
+        return self._limit_hits(observable,
+                                *await self._search_cached(observable))
+
+    async def get_data_many(self, observables):
+        """
+        Search for all the observables concurrently.
+        Returns hits per observable in the order of the observables,
+        warnings are added in the same order.
+        """
+        observables = [(observable['type'], observable['value'])
+                       for observable in observables]
+        results = await asyncio.gather(*map(self._search_cached,
+                                            dict.fromkeys(observables)))
+        results = dict(zip(dict.fromkeys(observables), results))
+        return [self._limit_hits(observable, *results[observable])
+                for observable in observables]
+
+    async def _discover_indices(self, candidates):
+        try:
+            response = await self._request(
+                path='dl/api/es/visualize',
+                method='POST',
+                body=self._discovery_payload(candidates)
+            )
+        except CriticalExabeamResponseError:
+            response = None
+        return self._discovered_indices(candidates, response)
+
+    async def get_indices(self, days_amount):
+        candidates = self._get_indices(days_amount)
+        if not self._indices_discovery:
+            return candidates
+
+        existing = indices_cache.get(self._indices_cache_key(candidates))
+        if existing is None:
+            existing = self._cache_indices(
+                candidates, await self._discover_indices(
+                    self._get_indices(MAX_DAYS_AMOUNT)
+                )
+            )
+        return self._existing_indices(candidates, existing)
+
+    async def get_visualize_data(self, aggregation_query, days_amount=None,
+                                 indices=None):
+        if indices is None:
+            indices = await self.get_indices(days_amount)
+        payload = self._get_visualize_payload(indices, aggregation_query)
+        response = await self._request(path='dl/api/es/visualize',
+                                       method='POST',
+                                       body=payload)
+        aggregations = response['aggregations']
+        return aggregations
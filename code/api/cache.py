@@ -0,0 +1,363 @@
+import marshal
+import os
+import sqlite3
+import stat
+import zlib
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from threading import Lock
+from time import monotonic, time
+
+SQLITE_BACKEND = 'sqlite'
+# Name of the database file of shared caches in CACHE_DIR.
+DATABASE_FILE = 'cache.sqlite3'
+
+# Marshaled values at least this long are stored compressed.
+COMPRESSION_MIN_SIZE = 1024
+# Seconds SQLite waits for a database locked by another process.
+SQLITE_BUSY_TIMEOUT = 1
+# Expired and excess entries of a shared cache are removed
+# after at most this many of its entries are set by a process.
+PRUNE_INTERVAL = 100
+
+
+class TTLCache:
+    """
+    Thread-safe in-process LRU cache.
+    Every entry expires after the TTL it was stored with.
+    When sizeof is given, the total size of the values
+    is also kept within maxbytes.
+    """
+
+    def __init__(self, maxsize, maxbytes=None, sizeof=None):
+        self._maxsize = maxsize
+        self._maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, _ = entry
+                if expires_at > monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl):
+        size = self._sizeof(value) if self._sizeof else 0
+        if self._maxbytes is not None and size > self._maxbytes:
+            return
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, monotonic() + ttl, size)
+            self.bytes += size
+            while (len(self._entries) > self._maxsize
+                   or (self._maxbytes is not None
+                       and self.bytes > self._maxbytes)):
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'bytes': self.bytes
+            }
+
+
+def _encode(value):
+    # Unlike pickle, marshal can't run code when a value is loaded.
+    data = marshal.dumps(value)
+    if len(data) >= COMPRESSION_MIN_SIZE:
+        return b'z' + zlib.compress(data, 1)
+    return b'm' + data
+
+
+def _decode(data):
+    if data[:1] == b'z':
+        return marshal.loads(zlib.decompress(data[1:]))
+    return marshal.loads(data[1:])
+
+
+def _check_private(status, path):
+    if status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise PermissionError(f'{path} is accessible to other users')
+
+
+class _Database:
+    """
+    Connections of a process to the SQLite database of shared caches,
+    which are reused by its threads one at a time.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._path = os.path.join(directory, DATABASE_FILE)
+        self._pid = None
+        self._connections = []
+        self._lock = Lock()
+
+    def setup(self):
+        # The database holds search results, so its directory, which also
+        # holds the WAL files, must be a private one of the user.
+        os.makedirs(self._directory, mode=0o700, exist_ok=True)
+        status = os.lstat(self._directory)
+        if not stat.S_ISDIR(status.st_mode):
+            raise NotADirectoryError(f'{self._directory} is not a directory')
+        _check_private(status, self._directory)
+
+        descriptor = os.open(self._path,
+                             os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            _check_private(os.fstat(descriptor), self._path)
+        finally:
+            os.close(descriptor)
+
+        # The connection isn't pooled, as the database may be set up
+        # by the master process before the workers are forked.
+        with closing(self._connect()) as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                'value BLOB NOT NULL, expires_at REAL NOT NULL, '
+                'size INTEGER NOT NULL, PRIMARY KEY (namespace, key)'
+                ') WITHOUT ROWID'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS cache_expires_at '
+                'ON cache (namespace, expires_at)'
+            )
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, timeout=SQLITE_BUSY_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            # Connections are not carried over to forked processes.
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._connections = []
+            connection = (self._connections.pop() if self._connections
+                          else None)
+
+        if connection is None:
+            connection = self._connect()
+
+        try:
+            yield connection
+        finally:
+            with self._lock:
+                if self._pid == os.getpid():
+                    self._connections.append(connection)
+
+
+class SQLiteCache:
+    """
+    Cache shared by all the processes of the container through
+    an SQLite database in WAL mode, with the interface of TTLCache.
+
+    Values are stored marshaled, and compressed when they are large.
+    Values marshal can't store, like instances of subclasses of built-in
+    types, aren't cached.
+    Entries over maxsize or maxbytes are evicted soonest to expire first.
+    Errors of the database are treated as cache misses.
+    """
+
+    def __init__(self, database, namespace, maxsize, maxbytes=None):
+        self._database = database
+        self._namespace = namespace
+        self._maxsize = maxsize
+        self._maxbytes = maxbytes
+        self._prune_interval = max(1, min(PRUNE_INTERVAL, maxsize // 10))
+        self._sets = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            with self._database.connection() as connection:
+                row = connection.execute(
+                    'SELECT value FROM cache WHERE namespace = ? '
+                    'AND key = ? AND expires_at > ?',
+                    (self._namespace, repr(key), time())
+                ).fetchone()
+            if row is not None:
+                value = _decode(row[0])
+                self.hits += 1
+                return value
+        except (sqlite3.Error, zlib.error, ValueError, EOFError, TypeError):
+            pass
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl):
+        try:
+            data = _encode(value)
+        except ValueError:
+            return
+        if self._maxbytes is not None and len(data) > self._maxbytes:
+            return
+
+        self._sets += 1
+        try:
+            with self._database.connection() as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                    (self._namespace, repr(key), data, time() + ttl,
+                     len(data))
+                )
+                if self._sets % self._prune_interval == 0:
+                    self._prune(connection)
+        except sqlite3.Error:
+            pass
+
+    def _prune(self, connection):
+        connection.execute(
+            'DELETE FROM cache WHERE namespace = ? AND expires_at <= ?',
+            (self._namespace, time())
+        )
+        size, total_bytes = self._size(connection)
+        excess = max(0, size - self._maxsize)
+        if self._maxbytes is not None and total_bytes > self._maxbytes:
+            entries = connection.execute(
+                'SELECT size FROM cache WHERE namespace = ? '
+                'ORDER BY expires_at', (self._namespace,)
+            )
+            excess_bytes = total_bytes - self._maxbytes
+            for index, (entry_size,) in enumerate(entries, 1):
+                excess_bytes -= entry_size
+                if excess_bytes <= 0:
+                    excess = max(excess, index)
+                    break
+        if excess:
+            connection.execute(
+                'DELETE FROM cache WHERE namespace = ? AND key IN ('
+                'SELECT key FROM cache WHERE namespace = ? '
+                'ORDER BY expires_at LIMIT ?)',
+                (self._namespace, self._namespace, excess)
+            )
+
+    def _size(self, connection):
+        return connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache '
+            'WHERE namespace = ?', (self._namespace,)
+        ).fetchone()
+
+    def delete(self, key):
+        try:
+            with self._database.connection() as connection:
+                connection.execute(
+                    'DELETE FROM cache WHERE namespace = ? AND key = ?',
+                    (self._namespace, repr(key))
+                )
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        try:
+            with self._database.connection() as connection:
+                connection.execute('DELETE FROM cache WHERE namespace = ?',
+                                   (self._namespace,))
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        size, total_bytes = 0, 0
+        try:
+            with self._database.connection() as connection:
+                size, total_bytes = self._size(connection)
+        except sqlite3.Error:
+            pass
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': size,
+            'bytes': total_bytes
+        }
+
+
+class Cache:
+    """
+    Cache whose backend is chosen by configure_caches: a TTLCache
+    of the process, the default, or an SQLiteCache shared by the
+    processes. Caches of values which can't be marshaled or which
+    must not leave the process, like credentials, aren't shared.
+    """
+    caches = {}
+
+    def __init__(self, name, maxsize, maxbytes=None, sizeof=None,
+                 shared=True):
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.shared = shared
+        self.backend = TTLCache(maxsize, maxbytes, sizeof)
+        self.caches[name] = self
+
+    def get(self, key, default=None):
+        return self.backend.get(key, default)
+
+    def set(self, key, value, ttl):
+        self.backend.set(key, value, ttl)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return self.backend.stats()
+
+
+def configure_caches(config):
+    """
+    Set up the backend of the caches from CACHE_BACKEND and CACHE_DIR.
+    When the database of the shared caches can't be set up,
+    the caches are kept in memory of every process.
+    """
+    if config['CACHE_BACKEND'] != SQLITE_BACKEND:
+        return
+
+    database = _Database(config['CACHE_DIR'])
+    try:
+        database.setup()
+    except (sqlite3.Error, OSError):
+        return
+
+    for cache in Cache.caches.values():
+        if cache.shared:
+            cache.backend = SQLiteCache(database, cache.name,
+                                        cache.maxsize, cache.maxbytes)
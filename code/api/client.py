@@ -1,7 +1,14 @@
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+from hashlib import sha256
+from heapq import merge
+from itertools import islice
+from threading import BoundedSemaphore, Lock
 
 from flask import current_app
-import requests
 from requests.exceptions import (
     SSLError,
     ConnectionError,
@@ -11,6 +18,7 @@ from requests.exceptions import (
     InvalidHeader
 )
 
+from api.cache import Cache
 from api.errors import (
     AuthorizationError,
     ExabeamSSLError,
@@ -18,37 +26,145 @@ from api.errors import (
     CriticalExabeamResponseError,
     MoreMessagesAvailableWarning
 )
+from api.json_provider import dumps, loads
+from api.metrics import (observe_exabeam_response, request_timings,
+                         span)
+from api.sessions import sessions
+from api.singleflight import SingleFlight
 from api.utils import add_error
 
 
 INVALID_CREDENTIALS = 'wrong key'
+AUDIT_EVENTS_EXCLUSION = 'NOT (event_subtype:"Exabeam Audit Event")'
+# Fields sightings are built from besides the data table
+# and fields which are never shown in the data table.
+SIGHTING_FIELDS = ['message', 'forwarder', 'exa_rawEventTime', 'indexTime']
+EXCLUDED_FIELDS = ['_*', '@*', 'Product', 'Vendor']
+
+# Maps (host, API key fingerprint, (type, value), size) to search hits
+# and the total number of hits.
+# Hits of raw log messages vary a lot in size,
+# so the cache is bounded by the size of the hits.
+search_cache = Cache('search', maxsize=10000, maxbytes=32 * 1024 * 1024,
+                     sizeof=lambda result: len(dumps(result)))
+
+# Maps (host, API key fingerprint, date) to the names of daily indices
+# which exist among the indices of the last 30 days.
+indices_cache = Cache('indices', maxsize=1024)
+INDICES_AGGREGATION = 'indices'
+# Words of a text the way the standard analyzer of Data Lake splits it
+# at Unicode word boundaries: dots and apostrophes don't split letters
+# or digits, colons don't split letters, commas don't split digits.
+WORD = re.compile(
+    r"\w+(?:(?:[.'\u2019]|(?<=[^\W\d]):(?=[^\W\d])|(?<=\d)[,;](?=\d))\w+)*"
+)
+OBSERVABLES_AGGREGATION = 'observables'
+MAX_DAYS_AMOUNT = 30
+# Identical Exabeam requests in flight in the process.
+requests_in_flight = SingleFlight()
+
+_host_semaphores = {}
+_host_semaphores_lock = Lock()
+
+
+def host_semaphore(host, limit):
+    """
+    Get the process-wide semaphore which caps the number of
+    simultaneous requests to the specified Exabeam host.
+    """
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = BoundedSemaphore(limit)
+        return _host_semaphores[host]
 
 
 class ExabeamClient:
-    def __init__(self, key):
+    def __init__(self, context, refresh_cache=False):
         self._headers = {
-            'ExaAuthToken': key,
+            'ExaAuthToken': context.key,
             'User-Agent': current_app.config['USER_AGENT']
         }
-        self._entities_limit = current_app.config['CTR_ENTITIES_LIMIT']
+        self._entities_limit = context.entities_limit
         self._entities_limit_default = current_app.config[
             'CTR_ENTITIES_LIMIT_DEFAULT']
-
-    @property
-    def _url(self):
-        url = current_app.config['EXABEAM_API_ENDPOINT']
-        return url.format(host=current_app.config['HOST'])
+        # Everything the client needs from the app config is read here,
+        # so that searches may be run from worker threads
+        # which have no application context.
+        self._host = context.host
+        self._url = current_app.config['EXABEAM_API_ENDPOINT'].format(
+            host=self._host
+        )
+        # Identifies the data the client has access to in cache keys.
+        self.fingerprint = (self._host,
+                            sha256(context.key.encode()).hexdigest())
+        self._max_concurrent_requests = current_app.config[
+            'EXABEAM_MAX_CONCURRENT_REQUESTS']
+        self._pool_size = current_app.config['EXABEAM_POOL_SIZE']
+        self._session_idle_timeout = current_app.config[
+            'EXABEAM_SESSION_IDLE_TIMEOUT']
+        self._request_coalescing = current_app.config[
+            'EXABEAM_REQUEST_COALESCING']
+        self._coalescing_timeout = current_app.config[
+            'EXABEAM_COALESCING_TIMEOUT']
+        self._search_batch_size = current_app.config[
+            'EXABEAM_SEARCH_BATCH_SIZE']
+        # One hit more than can be displayed
+        # tells that there are more messages available.
+        self._search_size = self._entities_limit_default + 1
+        self._indices_discovery = current_app.config[
+            'EXABEAM_INDICES_DISCOVERY']
+        self._indices_discovery_ttl = current_app.config[
+            'EXABEAM_INDICES_DISCOVERY_TTL']
+        self._field_targeted_search = current_app.config[
+            'EXABEAM_FIELD_TARGETED_SEARCH']
+        self._observable_type_fields = current_app.config[
+            'OBSERVABLE_TYPE_FIELDS']
+        self._two_phase_search = current_app.config[
+            'EXABEAM_TWO_PHASE_SEARCH']
+        self._search_shards = current_app.config['EXABEAM_SEARCH_SHARDS']
+        self._source = self._get_source_filter(
+            current_app.config['EXABEAM_SOURCE_COLUMNS']
+        )
+        self._message_max_length = current_app.config[
+            'EXABEAM_MESSAGE_MAX_LENGTH']
+        self._progressive_search_windows = current_app.config[
+            'EXABEAM_PROGRESSIVE_SEARCH_WINDOWS']
+        self._search_cache_ttl = current_app.config['SEARCH_CACHE_TTL']
+        self._search_negative_cache_ttl = current_app.config[
+            'SEARCH_NEGATIVE_CACHE_TTL']
+        self._refresh_cache = refresh_cache
+        # Searches may be made from other threads than the request's.
+        self._timings = request_timings()
 
     def health(self):
         return self._request(path='api/auth/check')
 
     def _request(self, path, method='GET', body=None,
-                 params=None, data_extractor=lambda r: r.json()):
+                 params=None, data_extractor=lambda r: loads(r.content)):
+        if not self._request_coalescing:
+            return self._send(path, method, body, params, data_extractor)
+
+        # Concurrent requests share responses only with the same
+        # credentials and the same way of extracting the data.
+        key = (*self.fingerprint, method, path, dumps(body), dumps(params),
+               getattr(data_extractor, '__func__', data_extractor))
+        return requests_in_flight.do(
+            key,
+            lambda: self._send(path, method, body, params, data_extractor),
+            self._coalescing_timeout
+        )
+
+    def _send(self, path, method, body, params, data_extractor):
         url = '/'.join([self._url, path])
 
         try:
-            response = requests.request(method, url, json=body,
-                                        params=params, headers=self._headers)
+            with host_semaphore(self._host, self._max_concurrent_requests), \
+                    sessions.session(self._host, self._pool_size,
+                                     self._session_idle_timeout) as session, \
+                    span('exabeam', self._timings) as request_span:
+                response = session.request(method, url, json=body,
+                                           params=params,
+                                           headers=self._headers)
         except SSLError as error:
             raise ExabeamSSLError(error)
         except (ConnectionError, MissingSchema, InvalidSchema, InvalidURL):
@@ -56,33 +172,45 @@ class ExabeamClient:
         except (UnicodeEncodeError, InvalidHeader):
             raise AuthorizationError(INVALID_CREDENTIALS)
 
+        observe_exabeam_response(path, request_span.duration,
+                                 len(response.content))
         if response.ok:
             return data_extractor(response)
 
         raise CriticalExabeamResponseError(response)
 
     @staticmethod
-    def _get_payload(indices, observable):
+    def _get_payload(indices, query, size, source=None):
         return {
             **ExabeamClient._get_indices_payload(indices),
-            'size': 101,
+            **({'_source': source} if source else {}),
+            'size': size,
             'sortBy': [
                 {
                     'field': 'indexTime',
                     'order': 'desc'
                 }
             ],
-            'query': f'"{observable}" AND NOT (event_subtype:'
-                     '"Exabeam Audit Event")'
+            'query': f'{query} AND {AUDIT_EVENTS_EXCLUSION}'
         }
 
+    @staticmethod
+    def _get_source_filter(columns):
+        """
+        Ask only for the fields sightings are built from: the given data
+        table columns or all fields but those left out of the data table.
+        """
+        if columns:
+            return {'includes': [*SIGHTING_FIELDS, *columns]}
+        return {'excludes': EXCLUDED_FIELDS}
+
     @staticmethod
     def _get_visualize_payload(indices, aggregation_query):
         return {
             'aggs': aggregation_query,
             'query': {
                 **ExabeamClient._get_indices_payload(indices),
-                'query': '* AND NOT (event_subtype:"Exabeam Audit Event")'
+                'query': f'* AND {AUDIT_EVENTS_EXCLUSION}'
             },
             'size': 0
         }
@@ -107,18 +235,451 @@ class ExabeamClient:
             indices.append(f'exabeam-{(today - delta).strftime("%Y.%m.%d")}')
         return indices
 
-    def get_data(self, observable):
-        indices = self._get_indices(30)
-        response = self._request(path='dl/api/es/search',
-                                 method='POST',
-                                 body=self._get_payload(indices, observable))
-        hits = response['responses'][0]['hits']['hits']
-        if len(hits) > self._entities_limit_default:
-            add_error(MoreMessagesAvailableWarning(observable))
+    def _search_hits(self, query, size, indices=None, source=None):
+        if indices is None:
+            indices = self.get_indices(MAX_DAYS_AMOUNT)
+        if self._is_sharded(indices):
+            return self._search_sharded(query, size, indices, source)
+        return self._search_request(indices, query, size, source)
+
+    def _search_request(self, indices, query, size, source=None):
+        return self._request(
+            path='dl/api/es/search',
+            method='POST',
+            body=self._get_payload(indices, query, size,
+                                   self._source if source is None
+                                   else source),
+            data_extractor=self._extract_hits
+        )
+
+    @staticmethod
+    def _extract_hits(response):
+        return loads(response.content)['responses'][0]['hits']['hits']
+
+    def _cap_messages(self, hits):
+        """
+        Cut log messages to EXABEAM_MESSAGE_MAX_LENGTH once hits
+        are attributed to observables, which needs the whole messages.
+        """
+        if self._message_max_length:
+            for hit in hits:
+                source = hit.get('_source', {})
+                message = source.get('message')
+                if (isinstance(message, str)
+                        and len(message) > self._message_max_length):
+                    source['message'] = \
+                        f'{message[:self._message_max_length]}...'
+        return hits
+
+    @staticmethod
+    def _index_time(hit):
+        return hit.get('sort', [hit.get('_source', {}).get('indexTime')])[0]
+
+    def _is_sharded(self, indices):
+        return self._search_shards > 1 and len(indices) > 1
+
+    def _shard_ranges(self, indices):
+        """
+        Split the indices into up to EXABEAM_SEARCH_SHARDS ranges
+        of consecutive indices.
+        """
+        shards = min(self._search_shards, len(indices))
+        shard_size = -(-len(indices) // shards)
+        return [indices[start:start + shard_size]
+                for start in range(0, len(indices), shard_size)]
+
+    @classmethod
+    def _merge_hits(cls, ranges_hits, size):
+        """
+        Merge the newest hits of every range of the indices
+        into the newest hits of all the indices.
+        """
+        return list(islice(
+            merge(*ranges_hits, key=cls._index_time, reverse=True), size
+        ))
+
+    def _search_sharded(self, query, size, indices, source=None):
+        """
+        Search EXABEAM_SEARCH_SHARDS ranges of the indices concurrently.
+        """
+        ranges = self._shard_ranges(indices)
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(self._search_request, range_, query, size,
+                                source)
+                for range_ in ranges
+            ]
+            ranges_hits = [future.result() for future in futures]
+        return self._merge_hits(ranges_hits, size)
+
+    def _search_windows(self, indices):
+        """
+        Yield the windows of EXABEAM_PROGRESSIVE_SEARCH_WINDOWS
+        newest indices, then the rest of the indices.
+        """
+        start = 0
+        for window in self._progressive_search_windows:
+            if start >= len(indices):
+                return
+            yield indices[start:start + window]
+            start += window
+
+        if start < len(indices):
+            yield indices[start:]
+
+    def _search(self, observable, size=None):
+        """
+        Search for an observable over all indices at once or, with
+        EXABEAM_PROGRESSIVE_SEARCH_WINDOWS, window by window from the
+        newest indices until enough hits are found. Indices are daily,
+        so hits of a newer window are newer than hits of older ones
+        and the result is the same as of the search over all indices.
+        """
+        query = self._query(observable)
+        size = size or self._search_size
+        if not self._progressive_search_windows:
+            return self._search_hits(query, size)
+
+        hits = []
+        for window in self._search_windows(self.get_indices(MAX_DAYS_AMOUNT)):
+            if len(hits) >= size:
+                break
+            hits.extend(self._search_hits(query, size - len(hits), window))
+        return hits
+
+    def _query(self, observable):
+        """
+        Build a query for the fields which may contain an observable of
+        the type with EXABEAM_FIELD_TARGETED_SEARCH, or for the whole log.
+        """
+        type_, value = observable
+        fields = self._observable_fields(type_)
+        if not fields:
+            return f'"{value}"'
+        return '({})'.format(
+            ' OR '.join(f'{field}:"{value}"' for field in fields)
+        )
+
+    def _observable_fields(self, type_):
+        if self._field_targeted_search:
+            return self._observable_type_fields.get(type_)
+
+    def _observable_text(self, observable, source):
+        fields = self._observable_fields(observable[0])
+        if fields:
+            source = [source.get(field) for field in fields
+                      if field in source]
+        return self._hit_text(source)
+
+    @staticmethod
+    def _words(text):
+        """
+        Lowercased words of the text, as Data Lake indexes them, joined
+        and surrounded with a separator, so that a phrase is contained
+        in a text only when its words are consecutive words of the text.
+        """
+        return '\0{}\0'.format('\0'.join(WORD.findall(text.lower())))
+
+    @staticmethod
+    def _hit_text(value):
+        if isinstance(value, dict):
+            value = list(value.values())
+        if isinstance(value, list):
+            return '\n'.join(map(ExabeamClient._hit_text, value))
+        return str(value)
+
+    def _search_batch(self, observables):
+        """
+        Take hits of the observables from the cache, unless it is
+        refreshed, and search for the rest of the observables.
+        Returns hits and the total number of hits per observable.
+        """
+        results = {}
+        if not self._refresh_cache:
+            for observable in observables:
+                result = search_cache.get(self._search_cache_key(observable))
+                if result is not None:
+                    results[observable] = result
+
+        missing = list(dict.fromkeys(
+            observable for observable in observables
+            if observable not in results
+        ))
+        if self._two_phase_search:
+            missing_results = self._search_counted(missing)
+        else:
+            missing_results = [(hits, len(hits)) for hits
+                               in self._search_together(missing)]
+
+        for observable, result in zip(missing, missing_results):
+            self._cap_messages(result[0])
+            results[observable] = result
+            search_cache.set(
+                self._search_cache_key(observable), result,
+                self._search_cache_ttl if result[1]
+                else self._search_negative_cache_ttl
+            )
+
+        return [results[observable] for observable in observables]
+
+    def _search_cache_key(self, observable):
+        # The number of hits cached depends on the search mode.
+        size = (self._entities_limit if self._two_phase_search
+                else self._search_size)
+        return (*self.fingerprint, observable, size)
+
+    def _count(self, observables):
+        """
+        Count hits of every observable with a single filters aggregation.
+        """
+        aggregation_query = {
+            OBSERVABLES_AGGREGATION: {
+                'filters': {
+                    'filters': {
+                        str(index): {
+                            'query_string': {
+                                'query': self._query(observable)
+                            }
+                        }
+                        for index, observable in enumerate(observables)
+                    }
+                }
+            }
+        }
+        buckets = self.get_visualize_data(
+            json.dumps(aggregation_query), MAX_DAYS_AMOUNT
+        )[OBSERVABLES_AGGREGATION]['buckets']
+        return [buckets[str(index)]['doc_count']
+                for index in range(len(observables))]
+
+    def _search_counted(self, observables):
+        """
+        Count hits of the observables first and search only for the
+        observables which have hits, no more hits than can be displayed.
+        """
+        if not observables:
+            return []
+
+        counts = self._count(observables)
+        with ThreadPoolExecutor(
+                max_workers=self._max_concurrent_requests) as executor:
+            futures = [
+                executor.submit(self._search, observable,
+                                min(count, self._entities_limit))
+                if count else None
+                for observable, count in zip(observables, counts)
+            ]
+            return [(future.result() if future else [], count)
+                    for future, count in zip(futures, counts)]
+
+    def _search_together(self, observables):
+        """
+        Search for several observables with a single OR'ed query
+        and split the hits back out per observable.
+
+        Hits are sorted by indexTime, so the hits of an observable in the
+        shared result are the newest hits of that observable. They are
+        complete unless the shared size budget is saturated, in which
+        case observables with fewer hits than a separate search would
+        return are searched for separately.
+
+        A hit is attributed to every observable whose words it contains
+        the way Data Lake matches phrases. When a hit contains the words
+        of none of them, the attribution could differ from separate
+        searches, so all the observables are searched for separately.
+        """
+        values = [self._words(value) for _, value in observables]
+        if len(observables) <= 1 or '\0\0' in values:
+            return [self._search(observable) for observable in observables]
+
+        size = self._search_size * len(observables)
+        query = ' OR '.join(self._query(observable)
+                            for observable in observables)
+        source = self._batch_source(observables)
+        hits = self._search_hits(f'({query})', size, source=source)
+
+        observables_hits = [[] for _ in observables]
+        for hit in hits:
+            hit_source = hit.get('_source', {})
+            texts = {}
+            matches = []
+            for observable, value in zip(observables, values):
+                fields = self._observable_fields(observable[0])
+                key = tuple(fields) if fields else None
+                if key not in texts:
+                    texts[key] = self._words(
+                        self._observable_text(observable, hit_source)
+                    )
+                matches.append(value in texts[key])
+            if not any(matches):
+                return [self._search(observable)
+                        for observable in observables]
+            if source != self._source:
+                hit = self._filter_source(hit)
+            for observable_hits, match in zip(observables_hits, matches):
+                if match:
+                    observable_hits.append(hit)
+
+        saturated = len(hits) >= size
+        return [
+            self._search(observable)
+            if saturated and len(observable_hits) < self._search_size
+            else observable_hits[:self._search_size]
+            for observable, observable_hits in zip(observables,
+                                                   observables_hits)
+        ]
+
+    def _batch_source(self, observables):
+        """
+        Hits of a batch are attributed by the fields searched for the
+        observables, so they are returned even if left out of sightings.
+        Free-text searches match any field, so all fields are returned.
+        """
+        fields_lists = [self._observable_fields(observable[0])
+                        for observable in observables]
+        if not all(fields_lists):
+            return {}
+
+        fields = [field for fields in fields_lists for field in fields]
+        if 'includes' in self._source:
+            return {'includes': [*self._source['includes'], *fields]}
+        return {'excludes': [
+            pattern for pattern in self._source['excludes']
+            if not any(fnmatchcase(field, pattern) for field in fields)
+        ]}
+
+    def _filter_source(self, hit):
+        """
+        Leave out of a hit of a batch the fields which the source filter
+        of separate searches doesn't return.
+        """
+        if 'includes' in self._source:
+            patterns, included = self._source['includes'], True
+        else:
+            patterns, included = self._source['excludes'], False
+        return {
+            **hit,
+            '_source': {
+                key: value for key, value in hit.get('_source', {}).items()
+                if any(fnmatchcase(key, pattern)
+                       for pattern in patterns) == included
+            }
+        }
+
+    def _limit_hits(self, observable, hits, total):
+        if total > self._entities_limit_default:
+            add_error(MoreMessagesAvailableWarning(observable[1]))
         return hits[:self._entities_limit]
 
-    def get_visualize_data(self, aggregation_query, days_amount):
-        indices = self._get_indices(days_amount)
+    def get_data(self, observable):
+        observable = (observable['type'], observable['value'])
+        return self._limit_hits(observable,
+                                *self._search_batch([observable])[0])
+
+    def iter_data(self, observables):
+        """
+        Search for several observables concurrently, up to
+        EXABEAM_SEARCH_BATCH_SIZE observables per search, or all of them
+        in a single batch with EXABEAM_TWO_PHASE_SEARCH, so that they are
+        counted together.
+        Yields hits per observable in the order of the observables.
+        Warnings are added from the calling thread,
+        so they end up in the request's flask.g.
+        """
+        observables = [(observable['type'], observable['value'])
+                       for observable in observables]
+        batch_size = (max(len(observables), 1) if self._two_phase_search
+                      else self._search_batch_size)
+        batches = [
+            observables[start:start + batch_size]
+            for start in range(0, len(observables), batch_size)
+        ]
+        executor = ThreadPoolExecutor(
+            max_workers=self._max_concurrent_requests
+        )
+        try:
+            futures = [executor.submit(self._search_batch, batch)
+                       for batch in batches]
+            for batch, future in zip(batches, futures):
+                for observable, result in zip(batch, future.result()):
+                    yield self._limit_hits(observable, *result)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @classmethod
+    def _discovery_payload(cls, candidates):
+        aggregation_query = {
+            INDICES_AGGREGATION: {
+                'terms': {
+                    'field': '_index',
+                    'size': len(candidates)
+                }
+            }
+        }
+        return cls._get_visualize_payload(candidates,
+                                          json.dumps(aggregation_query))
+
+    @staticmethod
+    def _discovered_indices(candidates, response):
+        """
+        Get the candidates with data from the response of discovery,
+        or all of them when the response is None or tells nothing.
+        """
+        try:
+            buckets = response['aggregations'][INDICES_AGGREGATION]['buckets']
+        except (KeyError, TypeError):
+            buckets = None
+        if not buckets:
+            # The indices can't be told apart, so none is skipped.
+            return set(candidates)
+        return {bucket['key'] for bucket in buckets}
+
+    def _discover_indices(self, candidates):
+        try:
+            response = self._request(
+                path='dl/api/es/visualize',
+                method='POST',
+                body=self._discovery_payload(candidates)
+            )
+        except CriticalExabeamResponseError:
+            response = None
+        return self._discovered_indices(candidates, response)
+
+    def _indices_cache_key(self, candidates):
+        return (*self.fingerprint, candidates[0])
+
+    def _cache_indices(self, candidates, existing):
+        indices_cache.set(self._indices_cache_key(candidates), existing,
+                          self._indices_discovery_ttl)
+        return existing
+
+    @staticmethod
+    def _existing_indices(candidates, existing):
+        return [candidates[0]] + [index for index in candidates[1:]
+                                  if index in existing]
+
+    def get_indices(self, days_amount):
+        """
+        Get names of the daily indices of the last days_amount days.
+        With EXABEAM_INDICES_DISCOVERY, indices which don't exist or have
+        no data are left out, except for the newest index, which may be
+        created after the indices have been discovered.
+        """
+        candidates = self._get_indices(days_amount)
+        if not self._indices_discovery:
+            return candidates
+
+        existing = indices_cache.get(self._indices_cache_key(candidates))
+        if existing is None:
+            existing = self._cache_indices(candidates, self._discover_indices(
+                self._get_indices(MAX_DAYS_AMOUNT)
+            ))
+        return self._existing_indices(candidates, existing)
+
+    def get_visualize_data(self, aggregation_query, days_amount=None,
+                           indices=None):
+        if indices is None:
+            indices = self.get_indices(days_amount)
         payload = self._get_visualize_payload(indices, aggregation_query)
         response = self._request(path='dl/api/es/visualize',
                                  method='POST',
@@ -2,13 +2,19 @@ import json
 
 from flask import Blueprint, current_app
 
+from api.cache import Cache
 from api.utils import jsonify_data, get_jwt, get_json
 from api.schemas import DashboardTileSchema, DashboardTileDataSchema
 from api.tiles.factory import TileFactory
+from api.async_client import (AsyncExabeamClient, async_client_enabled,
+                              run)
 from api.client import ExabeamClient
 
 dashboard_api = Blueprint('dashboard', __name__)
 
+# Maps (host, API key fingerprint, tile_id, period) to tile data.
+tile_data_cache = Cache('tile_data', maxsize=512)
+
 
 @dashboard_api.route('/tiles', methods=['POST'])
 def tiles():
@@ -25,16 +31,97 @@ def tile():
     return jsonify_data(tile_object.tile())
 
 
+def build_tile_data(client, tile_id, period, tile_object, visualize_data):
+    data = tile_object.tile_data(visualize_data, period)
+    tile_data_cache.set((*client.fingerprint, tile_id, period), data,
+                        current_app.config['TILE_DATA_CACHE_TTL'][period])
+    return data
+
+
+def group_tiles(tile_objects):
+    """
+    Splits tiles into groups whose aggregation queries can be merged
+    into one, i.e. the same aggregation name means the same aggregation.
+    """
+    groups = []
+    for tile_id, tile_object in tile_objects.items():
+        query = tile_object.aggregation_query()
+        for group_query, group in groups:
+            if all(group_query.get(name, aggregation) == aggregation
+                   for name, aggregation in query.items()):
+                group_query.update(query)
+                group[tile_id] = tile_object
+                break
+        else:
+            groups.append((query, {tile_id: tile_object}))
+    return groups
+
+
 @dashboard_api.route('/tiles/tile-data', methods=['POST'])
 def tile_data():
-    key = get_jwt()
+    context = get_jwt()
     payload = get_json(DashboardTileDataSchema())
-    tile_object = TileFactory.create_tile(payload['tile_id'])
-    aggregation_query = tile_object.aggregation_query()
-    client = ExabeamClient(key)
-    visualize_data = client.get_visualize_data(
-        json.dumps(aggregation_query),
-        current_app.config['TILE_PERIODS_MAP'][payload['period']]
-    )
-    return jsonify_data(tile_object.tile_data(visualize_data,
-                                              payload['period']))
+    tile_object = TileFactory.create_tile(payload['tile_id'], context)
+    if async_client_enabled():
+        client = AsyncExabeamClient(context)
+    else:
+        client = ExabeamClient(context)
+    cache_key = (*client.fingerprint, payload['tile_id'], payload['period'])
+
+    data = tile_data_cache.get(cache_key)
+    if data is None:
+        if isinstance(client, AsyncExabeamClient):
+            visualize_data = run(tile_object.visualize_data_async(
+                client, payload['period']
+            ))
+        else:
+            visualize_data = tile_object.visualize_data(client,
+                                                        payload['period'])
+        data = build_tile_data(client, payload['tile_id'], payload['period'],
+                               tile_object, visualize_data)
+    return jsonify_data(data)
+
+
+@dashboard_api.route('/tiles/tile-data/batch', methods=['POST'])
+def tile_data_batch():
+    context = get_jwt()
+    payload = get_json(DashboardTileDataSchema(many=True))
+    client = ExabeamClient(context)
+
+    tiles_data = {}
+    missing = {}
+    for item in payload:
+        tile_id, period = item['tile_id'], item['period']
+        if (tile_id, period) in tiles_data:
+            continue
+        tile_object = TileFactory.create_tile(tile_id, context)
+        data = tile_data_cache.get((*client.fingerprint, tile_id, period))
+        if data is None and tile_object.aggregates_separately:
+            visualize_data = tile_object.visualize_data(client, period)
+            data = build_tile_data(client, tile_id, period,
+                                   tile_object, visualize_data)
+        if data is None:
+            missing.setdefault(period, {})[tile_id] = tile_object
+        tiles_data[tile_id, period] = data
+
+    for period, tile_objects in missing.items():
+        for query, group in group_tiles(tile_objects):
+            visualize_data = client.get_visualize_data(
+                json.dumps(query),
+                current_app.config['TILE_PERIODS_MAP'][period]
+            )
+            for tile_id, tile_object in group.items():
+                tiles_data[tile_id, period] = build_tile_data(
+                    client, tile_id, period, tile_object,
+                    {name: visualize_data[name]
+                     for name in tile_object.aggregation_query()}
+                )
+
+    return jsonify_data([
+        {
+            'tile_id': tile_id,
+            'period': period,
+            'tile_data': data
+        }
+        for (tile_id, period), data in tiles_data.items()
+    ])
@@ -1,9 +1,12 @@
 from functools import partial
 
-from flask import Blueprint, g, current_app
+from flask import Blueprint, g, current_app, request
 
 from api.schemas import ObservableSchema
-from api.utils import get_json, get_jwt, jsonify_data, jsonify_result
+from api.utils import (get_json, get_jwt, jsonify_data, jsonify_result,
+                       is_cache_bypassed, stream_result)
+from api.async_client import (AsyncExabeamClient, async_client_enabled,
+                              run)
 from api.client import ExabeamClient
 from api.mapping import Sighting, source_uri
 
@@ -11,27 +14,59 @@ enrich_api = Blueprint('enrich', __name__)
 
 get_observables = partial(get_json, schema=ObservableSchema(many=True))
 
+STREAM_FORMATS = ('json', 'ndjson')
+
 
 @enrich_api.route('/observe/observables', methods=['POST'])
 def observe_observables():
-    key = get_jwt()
+    context = get_jwt()
     observables = get_observables()
 
-    g.sightings = []
+    if async_client_enabled():
+        client = AsyncExabeamClient(context,
+                                    refresh_cache=is_cache_bypassed())
+        observables_data = run(client.get_data_many(observables))
+    else:
+        client = ExabeamClient(context, refresh_cache=is_cache_bypassed())
+        observables_data = client.iter_data(observables)
+
+    stream = request.args.get('stream')
+    if stream not in STREAM_FORMATS:
+        observables_data = list(observables_data)
+
+    # Hits of observables searched while streaming can't be counted
+    # ahead, so parts of their sightings aren't shared.
+    sighting_map = Sighting(
+        context,
+        observables_data if isinstance(observables_data, list) else ()
+    )
+    sightings = (
+        sighting
+        for observable, data in zip(observables, observables_data)
+        for sighting in sighting_map.extract_many(data, observable)
+    )
+
+    if stream in STREAM_FORMATS:
+        return stream_result(observed(sightings, sighting_map),
+                             ndjson=stream == 'ndjson')
+
+    g.sightings = list(sightings)
+    response = jsonify_result()
+    sighting_map.observe()
+    return response
+
 
-    client = ExabeamClient(key)
-    sighting_map = Sighting()
-    for observable in observables:
-        data = client.get_data(observable['value'])
-        for data_item in data:
-            sighting = sighting_map.extract(data_item, observable)
-            g.sightings.append(sighting)
-    return jsonify_result()
+def observed(sightings, sighting_map):
+    """Report the time spent mapping the sightings once they are streamed."""
+    try:
+        yield from sightings
+    finally:
+        sighting_map.observe()
 
 
 @enrich_api.route('/refer/observables', methods=['POST'])
 def refer_observables():
-    _ = get_jwt()
+    context = get_jwt()
     observables = get_observables()
 
     obs_types_map = current_app.config['HUMAN_READABLE_OBSERVABLE_TYPES']
@@ -52,7 +87,7 @@ def refer_observables():
                 f'{obs_types_map.get(observable["type"], observable["type"])}'
                 ' in Exabeam Data Lake'
             ),
-            'url': source_uri(observable['value'], params),
+            'url': source_uri(context.host, observable['value'], params),
             'categories': ['Search', 'Exabeam']
         }
         for observable in observables
@@ -49,7 +49,9 @@ class WatchdogError(TRFormattedError):
 
 class ExabeamSSLError(TRFormattedError):
     def __init__(self, error):
-        error = error.args[0].reason.args[0]
+        # aiohttp keeps the error of the certificate as an attribute.
+        error = (getattr(error, 'certificate_error', None)
+                 or error.args[0].reason.args[0])
         message = getattr(error, 'verify_message', error.args[0]).capitalize()
         super().__init__(
             UNKNOWN,
@@ -8,7 +8,7 @@ health_api = Blueprint('health', __name__)
 
 @health_api.route('/health', methods=['POST'])
 def health():
-    key = get_jwt()
-    client = ExabeamClient(key)
+    context = get_jwt()
+    client = ExabeamClient(context)
     _ = client.health()
     return jsonify_data({'status': 'ok'})
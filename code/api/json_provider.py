@@ -0,0 +1,128 @@
+import codecs
+import json
+import re
+
+import flask
+from flask import current_app
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON_OPTIONS = (
+    getattr(orjson, 'OPT_SORT_KEYS', 0)
+    | getattr(orjson, 'OPT_PASSTHROUGH_DATETIME', 0)
+    | getattr(orjson, 'OPT_PASSTHROUGH_DATACLASS', 0)
+    | getattr(orjson, 'OPT_PASSTHROUGH_SUBCLASS', 0)
+)
+# orjson writes exponents of floats without a plus sign and leading zeros,
+# floats under 1e-4 without an exponent, and leaves non-ASCII characters
+# and DEL unescaped, unlike the stdlib, so its output is rewritten into
+# the form of the stdlib.
+ORJSON_FLOAT_FORMS = rb'-?(?:[0-9.]+e-?[0-9]+|0\.0000[0-9]*)'
+ORJSON_FLOAT_FORM = re.compile(rb'(?:^|[:,\[])' + ORJSON_FLOAT_FORMS)
+# Strings are matched along with the floats, so floats in them are kept.
+ORJSON_FLOAT = re.compile(rb'"(?:[^"\\]|\\.)*"|' + ORJSON_FLOAT_FORMS)
+ESCAPE_ERRORS = 'json_provider.escape'
+
+
+def _escape(error):
+    """Escape non-ASCII characters the way json.dumps does."""
+    escaped = []
+    for character in error.object[error.start:error.end]:
+        code = ord(character)
+        if code > 0xffff:
+            code -= 0x10000
+            escaped.append('\\u{:04x}\\u{:04x}'.format(
+                0xd800 | code >> 10, 0xdc00 | code & 0x3ff
+            ))
+        else:
+            escaped.append('\\u{:04x}'.format(code))
+    return ''.join(escaped), error.end
+
+
+codecs.register_error(ESCAPE_ERRORS, _escape)
+
+
+def _float(match):
+    token = match.group()
+    if token[:1] == b'"':
+        return token
+    return repr(float(token)).encode()
+
+
+def _stdlib_form(data):
+    if not data.isascii():
+        data = data.decode().encode('ascii', ESCAPE_ERRORS)
+    if b'\x7f' in data:
+        data = data.replace(b'\x7f', b'\\u007f')
+    if ORJSON_FLOAT_FORM.search(data):
+        data = ORJSON_FLOAT.sub(_float, data)
+    return data
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    """
+    Flask's JSON encoder which also serializes objects
+    providing their JSON representation with __json__.
+    """
+
+    def default(self, o):
+        if hasattr(o, '__json__'):
+            return o.__json__()
+        return super().default(o)
+
+
+_default = JSONEncoder().default
+
+
+class NonFiniteFloat(float):
+    """
+    NaN or an infinity parsed by the stdlib json module. orjson writes
+    them as null, unlike the stdlib, so it refuses this subclass and
+    dumps falls back to the stdlib.
+    """
+
+
+def dumps(obj):
+    """
+    Serialize obj the way flask.jsonify does by default: with sorted keys,
+    ASCII only and compact separators. orjson is used when it is installed
+    and can serialize obj, the stdlib json module otherwise.
+    """
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            pass
+        else:
+            return _stdlib_form(data)
+
+    return json.dumps(obj, cls=JSONEncoder, sort_keys=True,
+                      separators=(',', ':')).encode()
+
+
+def loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(data, parse_constant=NonFiniteFloat)
+
+
+def jsonify(obj):
+    """
+    Drop-in replacement for flask.jsonify(obj) backed by dumps.
+    Non-default JSON settings of the app are left to flask.jsonify.
+    """
+    config = current_app.config
+    if (current_app.debug or config['JSONIFY_PRETTYPRINT_REGULAR']
+            or not config['JSON_SORT_KEYS'] or not config['JSON_AS_ASCII']):
+        return flask.jsonify(obj)
+
+    return current_app.response_class(dumps(obj) + b'\n',
+                                      mimetype=config['JSONIFY_MIMETYPE'])
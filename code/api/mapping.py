@@ -1,7 +1,10 @@
+from collections import Counter
+from time import perf_counter
 from uuid import uuid5, NAMESPACE_X500
 
 from flask import current_app
 
+from api.metrics import add_span
 from api.utils import source_uri
 
 SIGHTING = 'sighting'
@@ -21,29 +24,97 @@ SIGHTING_DEFAULTS = {
     'count': 1
 }
 
+# Fields of logs which are not shown in the data table.
+EXCLUDED_FIRST_CHARACTERS = frozenset(('_', '@'))
+EXCLUDED_PREFIX = 'exa_'
+EXCLUDED_KEYS = frozenset(('message', 'Product', 'Vendor'))
+
+VALUE_PLACEHOLDER = '\0'
+
+
+class SightingRecord:
+    """
+    Compact sighting which keeps only references to its hit and
+    observable and is turned into the CTIM entity when serialized.
+    """
+    __slots__ = ('_mapping', '_data', '_observable')
+
+    def __init__(self, mapping, data, observable):
+        self._mapping = mapping
+        self._data = data
+        self._observable = observable
+
+    def __json__(self):
+        return self._mapping.sighting(self._data, self._observable)
+
 
 class Sighting:
-    def _sighting(self, data, observable):
+    def __init__(self, context, observables_hits=()):
+        # Source URIs of all sightings of a request differ only in value.
+        self._source_uri_parts = source_uri(
+            context.host, VALUE_PLACEHOLDER,
+            current_app.config['URL_PARAMS_FOR_SIGHTING']
+        ).split(VALUE_PLACEHOLDER)
+        # Sightings of a hit found for several of the given observables
+        # share the parts which do not depend on the observable.
+        # The parts are kept only until their last use.
+        ids = Counter(data.get('_id') for hits in observables_hits
+                      for data in hits)
+        self._uses = {hit_id: uses for hit_id, uses in ids.items()
+                      if uses > 1 and hit_id is not None}
+        self._shared = {}
+        # Sightings are mapped when serialized, so the time spent
+        # is added up and reported as a single span by observe.
+        self._seconds = 0
+
+    def sighting(self, data, observable):
+        start = perf_counter()
+        source = data.get('_source', {})
         sighting = {
-            'description': f'```\n{data.get("_source", {}).get("message")}'
-                           '\n```',
-            'short_description': self._short_description(
-                data.get('_source', {})
-            ),
+            'id': self._transient_id(source, observable),
+            'observables': [observable],
+            **self._shared_parts(data, source),
+            **SIGHTING_DEFAULTS
+        }
+
+        self._seconds += perf_counter() - start
+        return sighting
+
+    def observe(self):
+        """Report the time spent mapping sightings as the extract stage."""
+        add_span('extract', self._seconds)
+
+    def _shared_parts(self, data, source):
+        hit_id = data.get('_id')
+        uses = self._uses.get(hit_id)
+        if uses is None:
+            return self._parts(data, source)
+
+        parts = self._shared.get(hit_id)
+        if parts is None:
+            parts = self._shared[hit_id] = self._parts(data, source)
+        if uses > 1:
+            self._uses[hit_id] = uses - 1
+        else:
+            del self._uses[hit_id], self._shared[hit_id]
+        return parts
+
+    def _parts(self, data, source):
+        return {
+            'description': f'```\n{source.get("message")}\n```',
+            'short_description': self._short_description(source),
             'external_ids': [
                 data.get('_id')
             ],
-            'id': self._transient_id(data.get('_source', {}), observable),
-            'observables': [observable],
             'observed_time': {
-                'start_time': data.get('_source', {}).get('exa_rawEventTime')
+                'start_time': source.get('exa_rawEventTime')
             },
-            'data': self._data_table(data),
-            'source_uri': self.sighting_source_uri(data.get('_id', {})),
-            **SIGHTING_DEFAULTS
+            'data': self._data_table(source),
+            'source_uri': self._source_uri(data.get('_id', {}))
         }
 
-        return sighting
+    def _source_uri(self, value):
+        return str(value).join(self._source_uri_parts)
 
     @staticmethod
     def _transient_id(data, observable):
@@ -53,10 +124,8 @@ class Sighting:
         sighting_id = f'transient:{SIGHTING}-{uuid5(NAMESPACE_X500, seeds)}'
         return sighting_id
 
-    @staticmethod
-    def sighting_source_uri(value):
-        params = current_app.config['URL_PARAMS_FOR_SIGHTING']
-        return source_uri(value, params)
+    def sighting_source_uri(self, value):
+        return self._source_uri(value)
 
     @staticmethod
     def _short_description(data):
@@ -64,21 +133,26 @@ class Sighting:
                'containing the observable'
 
     @staticmethod
-    def _data_table(data):
-        data_table = {
-            'columns': [],
-            'rows': [[]]
-        }
+    def _data_table(source):
+        columns = []
+        row = []
 
-        for key, value in data.get('_source', {}).items():
-            key_check = key.startswith(('_', 'exa_', '@')) \
-                        or key in ['message', 'Product', 'Vendor']
-            if not key_check and value:
-                data_table['columns'].append({'name': key, 'type': 'string'})
-                data_table['rows'][0].append(value)
+        for key, value in source.items():
+            if (value
+                    and key[:1] not in EXCLUDED_FIRST_CHARACTERS
+                    and key[:4] != EXCLUDED_PREFIX
+                    and key not in EXCLUDED_KEYS):
+                columns.append({'name': key, 'type': 'string'})
+                row.append(value)
 
-        return data_table
+        return {
+            'columns': columns,
+            'rows': [row]
+        }
 
     def extract(self, data, observable):
-        sighting = self._sighting(data, observable)
+        sighting = SightingRecord(self, data, observable)
         return sighting
+
+    def extract_many(self, hits, observable):
+        return [SightingRecord(self, data, observable) for data in hits]
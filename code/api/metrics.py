@@ -0,0 +1,280 @@
+import json
+import os
+from bisect import bisect_left
+from glob import glob
+from threading import Lock
+from time import monotonic, perf_counter
+from uuid import uuid4
+
+from flask import (Blueprint, current_app, g, has_request_context, request,
+                   Response)
+from werkzeug.exceptions import NotFound
+
+from api.cache import Cache
+
+metrics_api = Blueprint('metrics', __name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(8))
+
+STAGE_SECONDS = 'relay_stage_seconds'
+REQUEST_SECONDS = 'relay_request_seconds'
+EXABEAM_REQUEST_SECONDS = 'relay_exabeam_request_seconds'
+EXABEAM_RESPONSE_BYTES = 'relay_exabeam_response_bytes'
+HISTOGRAMS = {
+    STAGE_SECONDS: ('stage', LATENCY_BUCKETS),
+    REQUEST_SECONDS: ('endpoint', LATENCY_BUCKETS),
+    EXABEAM_REQUEST_SECONDS: ('path', LATENCY_BUCKETS),
+    EXABEAM_RESPONSE_BYTES: ('path', SIZE_BUCKETS)
+}
+CACHE_HITS = 'relay_cache_hits_total'
+CACHE_MISSES = 'relay_cache_misses_total'
+CACHE_HIT_RATIO = 'relay_cache_hit_ratio'
+
+_enabled = False
+_lock = Lock()
+# Maps (histogram name, label value) to the counts of its buckets
+# followed by the sum and the count of the observed values.
+_histograms = {}
+_process_id = None
+_flushed_at = 0
+
+
+def _reset():
+    global _process_id, _flushed_at
+    _histograms.clear()
+    _process_id = f'{os.getpid()}-{uuid4().hex[:8]}'
+    _flushed_at = 0
+
+
+_reset()
+# Forked workers start with no metrics of their own.
+os.register_at_fork(after_in_child=_reset)
+
+
+def observe(name, label, value):
+    if not _enabled:
+        return
+
+    buckets = HISTOGRAMS[name][1]
+    with _lock:
+        counts = _histograms.get((name, label))
+        if counts is None:
+            counts = _histograms[name, label] = [0] * (len(buckets) + 2)
+        index = bisect_left(buckets, value)
+        if index < len(buckets):
+            counts[index] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+
+class _Span:
+    __slots__ = ('_stage', '_timings', '_start', 'duration')
+
+    def __init__(self, stage, timings):
+        self._stage = stage
+        self._timings = timings
+        self.duration = 0
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = perf_counter() - self._start
+        _add_span(self._stage, self.duration, self._timings)
+
+
+def _add_span(stage, duration, timings):
+    observe(STAGE_SECONDS, stage, duration)
+    if timings is not None:
+        timings.append((stage, duration))
+
+
+class _NullSpan:
+    duration = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def request_timings():
+    """
+    Get the list the spans of the current request are added to,
+    to be passed to the spans made from threads without the request.
+    """
+    if _enabled and has_request_context():
+        return g.setdefault('timings', [])
+
+
+def span(stage, timings=None):
+    """
+    Measure the time spent in the stage of the current request,
+    or of the request of the given timings, when metrics are enabled.
+    """
+    if not _enabled:
+        return _null_span
+    if timings is None:
+        timings = request_timings()
+    return _Span(stage, timings)
+
+
+def add_span(stage, duration, timings=None):
+    """
+    Add a span of a stage whose duration is measured piecemeal,
+    like span does, when metrics are enabled.
+    """
+    if _enabled:
+        _add_span(stage, duration,
+                  request_timings() if timings is None else timings)
+
+
+def observe_exabeam_response(path, seconds, size):
+    observe(EXABEAM_REQUEST_SECONDS, path, seconds)
+    observe(EXABEAM_RESPONSE_BYTES, path, size)
+
+
+def _snapshot():
+    with _lock:
+        histograms = [[name, label, list(counts)]
+                      for (name, label), counts in _histograms.items()]
+    caches = [[cache.name, cache.backend.hits, cache.backend.misses]
+              for cache in Cache.caches.values()]
+    return {'histograms': histograms, 'caches': caches}
+
+
+def _flush(directory):
+    """
+    Write the metrics of the process to its file in the directory,
+    so that they are added up with the metrics of other processes.
+    """
+    global _flushed_at
+    _flushed_at = monotonic()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{_process_id}.json')
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(_snapshot(), file)
+    os.replace(f'{path}.tmp', path)
+
+
+def _before_request():
+    g.request_started_at = perf_counter()
+
+
+def _after_request(response):
+    if 'request_started_at' in g:
+        duration = perf_counter() - g.request_started_at
+        observe(REQUEST_SECONDS, request.endpoint or '', duration)
+        timings = [*g.get('timings', []), ('total', duration)]
+        response.headers['Server-Timing'] = server_timing(timings)
+
+    if (monotonic() - _flushed_at
+            >= current_app.config['METRICS_FLUSH_INTERVAL']):
+        _flush(current_app.config['METRICS_DIR'])
+    return response
+
+
+def server_timing(timings):
+    """
+    Format timings as a Server-Timing header with the total duration
+    of every stage and the number of its spans when there are several.
+    """
+    stages = {}
+    for stage, duration in timings:
+        total, count = stages.get(stage, (0, 0))
+        stages[stage] = (total + duration, count + 1)
+
+    return ', '.join(
+        f'{stage};dur={total * 1000:.1f}'
+        + (f';desc="{count} spans"' if count > 1 else '')
+        for stage, (total, count) in stages.items()
+    )
+
+
+def configure_metrics(app):
+    """
+    Enable metrics with METRICS_ENABLED. Nothing is measured otherwise,
+    spans and hooks cost a check of a flag or nothing.
+    """
+    global _enabled
+    _enabled = app.config['METRICS_ENABLED']
+    if _enabled:
+        app.before_request(_before_request)
+        app.after_request(_after_request)
+
+
+def _label(name, value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'{name}="{value}"'
+
+
+def render(snapshots):
+    """
+    Add up snapshots of the processes in the Prometheus text format.
+    """
+    histograms = {}
+    caches = {}
+    for snapshot in snapshots:
+        for name, label, counts in snapshot['histograms']:
+            total = histograms.setdefault((name, label), [0] * len(counts))
+            for index, count in enumerate(counts):
+                total[index] += count
+        for name, hits, misses in snapshot['caches']:
+            total = caches.setdefault(name, [0, 0])
+            total[0] += hits
+            total[1] += misses
+
+    lines = []
+    for name, (label_name, buckets) in HISTOGRAMS.items():
+        lines.append(f'# TYPE {name} histogram')
+        for (histogram, label), counts in sorted(histograms.items()):
+            if histogram != name:
+                continue
+            label = _label(label_name, label)
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label},le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{name}_bucket{{{label},le="+Inf"}} {counts[-1]}')
+            lines.append(f'{name}_sum{{{label}}} {counts[-2]}')
+            lines.append(f'{name}_count{{{label}}} {counts[-1]}')
+
+    for name, index in ((CACHE_HITS, 0), (CACHE_MISSES, 1)):
+        lines.append(f'# TYPE {name} counter')
+        for cache, counts in sorted(caches.items()):
+            lines.append(f'{name}{{{_label("cache", cache)}}} '
+                         f'{counts[index]}')
+
+    lines.append(f'# TYPE {CACHE_HIT_RATIO} gauge')
+    for cache, (hits, misses) in sorted(caches.items()):
+        if hits + misses:
+            lines.append(f'{CACHE_HIT_RATIO}{{{_label("cache", cache)}}} '
+                         f'{hits / (hits + misses)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+@metrics_api.route('/metrics', methods=['GET'])
+def metrics():
+    if not _enabled:
+        raise NotFound()
+
+    directory = current_app.config['METRICS_DIR']
+    _flush(directory)
+    snapshots = []
+    for path in glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+
+    return Response(render(snapshots),
+                    mimetype='text/plain; version=0.0.4')
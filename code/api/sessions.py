@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock
+from time import monotonic
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class _PooledSession:
+    def __init__(self, pool_size):
+        self.session = requests.Session()
+        # Sessions are shared between credentials,
+        # so no cookies may be carried from one request to another.
+        self.session.cookies.set_policy(
+            DefaultCookiePolicy(allowed_domains=[])
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.in_use = 0
+        self.last_used = monotonic()
+
+
+class SessionPool:
+    """
+    Per-process pool of keep-alive HTTP sessions, one per host.
+
+    A session keeps up to pool_size open connections to its host and is
+    shared by all the threads of a worker. Sessions which have not been
+    used for idle_timeout seconds are closed, so no stale connections
+    are kept to hosts which are not queried anymore.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = Lock()
+
+    @contextmanager
+    def session(self, host, pool_size, idle_timeout):
+        with self._lock:
+            self._evict_idle(idle_timeout)
+            pooled = self._sessions.get(host)
+            if pooled is None:
+                pooled = self._sessions[host] = _PooledSession(pool_size)
+            pooled.in_use += 1
+
+        try:
+            yield pooled.session
+        finally:
+            with self._lock:
+                pooled.in_use -= 1
+                pooled.last_used = monotonic()
+
+    def _evict_idle(self, idle_timeout):
+        now = monotonic()
+        for host, pooled in list(self._sessions.items()):
+            if not pooled.in_use and now - pooled.last_used > idle_timeout:
+                del self._sessions[host]
+                pooled.session.close()
+
+
+sessions = SessionPool()
@@ -5,7 +5,8 @@ from api.utils import source_uri
 
 
 class AffectedIPsTile(AbstractTile):
-    def __init__(self):
+    def __init__(self, context=None):
+        super().__init__(context)
         self._aggregation_fields = {
             'is_ransomware_src_ip': 'Ransomware IPs',
             'is_threat_src_ip': 'Threat IPs',
@@ -37,14 +38,14 @@ class AffectedIPsTile(AbstractTile):
     def _periods(self):
         return ['last_30_days']
 
-    @staticmethod
-    def _data_item(field, label, value):
+    def _data_item(self, field, label, value):
         return {
             'icon': 'warning',
             'label': label,
             'value': value,
             'value_unit': 'integer',
             'link_uri': source_uri(
+                self._context.host,
                 f'{field}:"true"',
                 current_app.config['URL_PARAMS_FOR_TILE']
             )
@@ -20,12 +20,12 @@ class DonutTile(AbstractTile, ABC):
     def _periods(self):
         return ['last_30_days']
 
-    @staticmethod
-    def _data_item(label_index, value, field, field_value):
+    def _data_item(self, label_index, value, field, field_value):
         return {
             'key': label_index,
             'value': value,
             'link_uri': source_uri(
+                self._context.host,
                 f'{field.split(".")[0]}:"{field_value}"',
                 current_app.config['URL_PARAMS_FOR_TILE']
             )
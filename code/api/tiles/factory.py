@@ -1,3 +1,4 @@
+import json
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
 
@@ -9,6 +10,10 @@ INVALID_CHART_ID = 'Invalid chart id'
 
 
 class AbstractTile(ABC):
+    def __init__(self, context=None):
+        # RequestContext of the request, needed only for tile data.
+        self._context = context
+
     @staticmethod
     def _observed_time(period):
         delta = timedelta(days=current_app.config['TILE_PERIODS_MAP'][period])
@@ -21,11 +26,19 @@ class AbstractTile(ABC):
 
     @staticmethod
     def _valid_time(period):
-        return AbstractTile._observed_time(period)
+        ttl = current_app.config['TILE_DATA_CACHE_TTL'][period]
+        now = datetime.now()
+
+        return {
+            'start_time': now.isoformat(timespec='milliseconds'),
+            'end_time': (now + timedelta(seconds=ttl)).isoformat(
+                timespec='milliseconds'
+            )
+        }
 
     @staticmethod
     def _cache_scope():
-        return 'none'
+        return 'org'
 
     @abstractmethod
     def _data(self):
@@ -66,6 +79,26 @@ class AbstractTile(ABC):
         """Returns query which is used
         by client to make a visualize request."""
 
+    @property
+    def aggregates_separately(self):
+        """Whether aggregations of the tile can't be requested
+        together with aggregations of other tiles."""
+        return False
+
+    def visualize_data(self, client, period):
+        """Returns aggregations which tile data is built from."""
+        return client.get_visualize_data(
+            json.dumps(self.aggregation_query()),
+            current_app.config['TILE_PERIODS_MAP'][period]
+        )
+
+    async def visualize_data_async(self, client, period):
+        """visualize_data with an AsyncExabeamClient."""
+        return await client.get_visualize_data(
+            json.dumps(self.aggregation_query()),
+            current_app.config['TILE_PERIODS_MAP'][period]
+        )
+
     @property
     def _tags(self):
         """Returns tile tags."""
@@ -90,10 +123,10 @@ class AbstractTile(ABC):
 
 class TileFactory:
     @staticmethod
-    def create_tile(tile_id):
+    def create_tile(tile_id, context=None):
         for cls in TileFactory.get_leaf_subclasses(AbstractTile):
             if cls()._id == tile_id:
-                return cls()
+                return cls(context)
         raise TRFormattedError(400, INVALID_CHART_ID)
 
     @staticmethod
@@ -1,11 +1,26 @@
+import json
+from collections import Counter
 from datetime import datetime, timezone
 from abc import ABC, abstractmethod
 
 from flask import current_app
 
+from api.cache import Cache
+from api.client import INDICES_AGGREGATION
 from api.tiles.factory import AbstractTile
 from api.utils import source_uri
 
+DAY_MS = 24 * 60 * 60 * 10**3
+# Data Lake returns 10 terms per bucket unless told otherwise.
+TERMS_SIZE = 10
+# Terms aggregated per index, more than displayed, so that terms
+# split between indices are still counted in the merged buckets.
+INDEX_TERMS_SIZE = 50
+
+# Maps (host, API key fingerprint, tile id, index) to the daily buckets
+# aggregated from an index which is not written to anymore.
+closed_indices_cache = Cache('closed_indices', maxsize=1024)
+
 
 class HorizontalBarTile(AbstractTile, ABC):
     @property
@@ -35,6 +50,7 @@ class HorizontalBarTile(AbstractTile, ABC):
             'key': key,
             'value': value,
             'link_uri': source_uri(
+                self._context.host,
                 f'{self._aggregation_field.split(".")[0]}:"{key}"',
                 current_app.config['URL_PARAMS_FOR_TILE'].replace('now-30d',
                                                                   'now-1d')
@@ -67,7 +83,11 @@ class HorizontalBarTile(AbstractTile, ABC):
                     keys.append(inner_bucket['key'])
         return keys
 
-    def aggregation_query(self):
+    def aggregation_query(self, terms_size=None):
+        terms = {'field': self._aggregation_field}
+        if terms_size:
+            terms['size'] = terms_size
+
         return {
             self._id: {
                 'date_histogram': {
@@ -77,14 +97,152 @@ class HorizontalBarTile(AbstractTile, ABC):
                 },
                 'aggs': {
                     self._aggregation_field: {
-                        'terms': {
-                            'field': self._aggregation_field
-                        }
+                        'terms': terms
                     }
                 }
             }
         }
 
+    def _indices_aggregation_query(self, indices):
+        return json.dumps({
+            INDICES_AGGREGATION: {
+                'terms': {
+                    'field': '_index',
+                    'size': len(indices)
+                },
+                'aggs': self.aggregation_query(INDEX_TERMS_SIZE)
+            }
+        })
+
+    def _merge_buckets(self, indices_buckets):
+        """
+        Merges daily buckets of separate indices into the buckets
+        the aggregation over all of the indices returns.
+        """
+        days = {}
+        for buckets in indices_buckets:
+            for bucket in buckets:
+                terms = days.setdefault(bucket['key'], Counter())
+                for inner_bucket in bucket[self._aggregation_field]['buckets']:
+                    terms[inner_bucket['key']] += inner_bucket['doc_count']
+
+        if not days:
+            return []
+
+        merged = []
+        for key in range(min(days), max(days) + DAY_MS, DAY_MS):
+            terms = days.get(key, Counter())
+            top_terms = sorted(terms.items(),
+                               key=lambda term: (-term[1], term[0]))
+            merged.append({
+                'key': key,
+                'doc_count': sum(terms.values()),
+                self._aggregation_field: {
+                    'buckets': [
+                        {'key': term, 'doc_count': doc_count}
+                        for term, doc_count in top_terms[:TERMS_SIZE]
+                    ]
+                }
+            })
+        return merged
+
+    @property
+    def aggregates_separately(self):
+        return current_app.config['TILE_INCREMENTAL_AGGREGATION']
+
+    def visualize_data(self, client, period):
+        """
+        Past daily indices don't change, so their buckets are aggregated
+        once and only the TILE_OPEN_INDICES newest indices are aggregated
+        on every request. Without buckets of indices in the response,
+        all the indices are aggregated together.
+        """
+        if not current_app.config['TILE_INCREMENTAL_AGGREGATION']:
+            return super().visualize_data(client, period)
+
+        indices = client.get_indices(
+            current_app.config['TILE_PERIODS_MAP'][period]
+        )
+        indices_buckets, missing = self._cached_buckets(client, indices)
+        if missing and not self._add_fetched_buckets(
+                client, indices, indices_buckets, missing,
+                client.get_visualize_data(
+                    self._indices_aggregation_query(missing), indices=missing
+                )):
+            return super().visualize_data(client, period)
+        return self._indices_visualize_data(indices_buckets)
+
+    async def visualize_data_async(self, client, period):
+        """visualize_data with an AsyncExabeamClient."""
+        if not current_app.config['TILE_INCREMENTAL_AGGREGATION']:
+            return await super().visualize_data_async(client, period)
+
+        indices = await client.get_indices(
+            current_app.config['TILE_PERIODS_MAP'][period]
+        )
+        indices_buckets, missing = self._cached_buckets(client, indices)
+        if missing and not self._add_fetched_buckets(
+                client, indices, indices_buckets, missing,
+                await client.get_visualize_data(
+                    self._indices_aggregation_query(missing), indices=missing
+                )):
+            return await super().visualize_data_async(client, period)
+        return self._indices_visualize_data(indices_buckets)
+
+    def _cached_buckets(self, client, indices):
+        """
+        Get the cached buckets of the closed indices
+        and the indices whose buckets are to be aggregated.
+        """
+        closed_indices = indices[current_app.config['TILE_OPEN_INDICES']:]
+
+        indices_buckets = {}
+        for index in closed_indices:
+            buckets = closed_indices_cache.get(
+                (*client.fingerprint, self._id, index)
+            )
+            if buckets is not None:
+                indices_buckets[index] = buckets
+        missing = [index for index in indices if index not in indices_buckets]
+        return indices_buckets, missing
+
+    def _add_fetched_buckets(self, client, indices, indices_buckets,
+                             missing, aggregations):
+        """
+        Add the buckets of the missing indices from the aggregations
+        and cache those of closed indices. Returns False when there are
+        no buckets of indices, as the indices can't be told apart.
+        """
+        try:
+            fetched = {
+                bucket['key']: bucket[self._id]['buckets']
+                for bucket in aggregations[INDICES_AGGREGATION]['buckets']
+            }
+        except (KeyError, TypeError):
+            return False
+        if not fetched:
+            return False
+
+        closed_indices = indices[current_app.config['TILE_OPEN_INDICES']:]
+        for index in missing:
+            indices_buckets[index] = fetched.get(index, [])
+            # An index without a bucket may be missing from the response
+            # only by chance, so it isn't cached.
+            if index in closed_indices and index in fetched:
+                closed_indices_cache.set(
+                    (*client.fingerprint, self._id, index),
+                    fetched[index],
+                    current_app.config['TILE_CLOSED_INDEX_CACHE_TTL']
+                )
+        return True
+
+    def _indices_visualize_data(self, indices_buckets):
+        return {
+            self._id: {
+                'buckets': self._merge_buckets(indices_buckets.values())
+            }
+        }
+
     def tile_data(self, visualize_data, period):
         return {
             'observed_time': self._observed_time(period),
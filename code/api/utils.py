@@ -1,16 +1,24 @@
 import json
+from collections import namedtuple
+from hashlib import sha256
+from itertools import chain
 from json.decoder import JSONDecodeError
+from time import monotonic, time
 
 import jwt
 import requests
-from flask import request, jsonify, current_app, g
+from flask import request, current_app, g, stream_with_context
 from jwt import (InvalidSignatureError,
                  DecodeError,
                  InvalidAudienceError,
                  MissingRequiredClaimError)
 from requests.exceptions import ConnectionError, InvalidURL, HTTPError
 
-from api.errors import AuthorizationError, InvalidArgumentError
+from api.cache import Cache
+from api.errors import (AuthorizationError, InvalidArgumentError,
+                        TRFormattedError, UNKNOWN)
+from api.json_provider import jsonify, dumps
+from api.metrics import span
 
 NO_AUTH_HEADER = 'Authorization header is missing'
 WRONG_AUTH_TYPE = 'Wrong authorization type'
@@ -27,9 +35,25 @@ WRONG_JWKS_HOST = ('Wrong jwks_host in JWT payload. Make sure domain follows '
                    'the visibility.<region>.cisco.com structure')
 
 
-def get_public_key(jwks_host, token):
+# Module instance a request is made for: the Exabeam host, the API key
+# and the maximum number of entities of a type to return.
+RequestContext = namedtuple('RequestContext',
+                            ['host', 'key', 'entities_limit'])
+
+# Maps digests of verified tokens, together with the audience
+# they were verified for, to the decoded payloads, which hold
+# Exabeam API keys, so the cache isn't shared with other processes.
+token_cache = Cache('tokens', maxsize=1024, shared=False)
+
+# Maps jwks_host to (fetched_at, {kid: public key}),
+# or to None for hosts which failed to return the keys.
+# Public keys can't be marshaled, so the cache isn't shared.
+jwks_cache = Cache('jwks', maxsize=16, shared=False)
+
+
+def fetch_public_keys(jwks_host):
     """
-    Get public key by requesting it from specified jwks host.
+    Request public keys from specified jwks host and build them by kid.
     """
 
     expected_errors = (
@@ -50,13 +74,49 @@ def get_public_key(jwks_host, token):
             public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(
                 json.dumps(jwk)
             )
-        kid = jwt.get_unverified_header(token)['kid']
-        return public_keys.get(kid)
+        return public_keys
 
     except expected_errors:
         raise AuthorizationError(WRONG_JWKS_HOST)
 
 
+def get_public_key(jwks_host, token):
+    """
+    Get public key from the cache of keys of specified jwks host.
+    Keys are requested again when they expire or when the kid is not
+    among them, which happens when the keys are rotated.
+    """
+
+    try:
+        kid = jwt.get_unverified_header(token)['kid']
+    except KeyError:
+        raise AuthorizationError(WRONG_JWKS_HOST)
+
+    cached = jwks_cache.get(jwks_host, default=())
+    if cached is None:
+        raise AuthorizationError(WRONG_JWKS_HOST)
+
+    if cached:
+        fetched_at, public_keys = cached
+        refresh_interval = current_app.config['JWKS_REFRESH_INTERVAL']
+        if kid in public_keys or monotonic() - fetched_at < refresh_interval:
+            return public_keys.get(kid)
+
+    try:
+        with span('jwks'):
+            public_keys = fetch_public_keys(jwks_host)
+    except AuthorizationError:
+        if cached:
+            return cached[1].get(kid)
+        jwks_cache.set(jwks_host, None,
+                       current_app.config['JWKS_NEGATIVE_CACHE_TTL'])
+        raise
+
+    jwks_cache.set(jwks_host, (monotonic(), public_keys),
+                   current_app.config['JWKS_CACHE_TTL'])
+    return public_keys.get(kid)
+
+
 def get_auth_token():
     """
     Parse and validate incoming request Authorization header.
@@ -73,10 +133,28 @@ def get_auth_token():
         raise AuthorizationError(expected_errors[error.__class__])
 
 
+def verify_jwt(token, aud):
+    """
+    Validate token signature against the public key
+    from /.well-known/jwks endpoint and return its payload.
+    """
+    jwks_host = jwt.decode(
+        token, options={'verify_signature': False}
+    )['jwks_host']
+    key = get_public_key(jwks_host, token)
+    payload = jwt.decode(
+        token, key=key, algorithms=['RS256'], audience=[aud]
+    )
+    assert 'host' in payload
+    assert 'key' in payload
+    return payload
+
+
 def get_jwt():
     """
-    Get Authorization token and validate its signature
-    against the public key from /.well-known/jwks endpoint.
+    Get Authorization token, validate it and return the RequestContext.
+    Tokens which have already been verified for the same audience
+    are taken from the cache until they expire.
     """
 
     expected_errors = {
@@ -89,23 +167,34 @@ def get_jwt():
         MissingRequiredClaimError: WRONG_PAYLOAD_STRUCTURE
     }
     token = get_auth_token()
-    try:
-        jwks_host = jwt.decode(
-            token, options={'verify_signature': False}
-        )['jwks_host']
-        key = get_public_key(jwks_host, token)
-        aud = request.url_root
-        payload = jwt.decode(
-            token, key=key, algorithms=['RS256'], audience=[aud.rstrip('/')]
-        )
-        assert 'host' in payload
-        assert 'key' in payload
-        set_entities_limit(payload)
-        current_app.config['HOST'] = payload['host']
-        return payload['key']
-    except tuple(expected_errors) as error:
-        message = expected_errors[error.__class__]
-        raise AuthorizationError(message)
+    aud = request.url_root.rstrip('/')
+    digest = sha256(f'{aud} {token}'.encode()).hexdigest()
+
+    payload = token_cache.get(digest)
+    if payload is None:
+        try:
+            with span('jwt'):
+                payload = verify_jwt(token, aud)
+        except tuple(expected_errors) as error:
+            message = expected_errors[error.__class__]
+            raise AuthorizationError(message)
+
+        ttl = current_app.config['JWT_CACHE_TTL']
+        if 'exp' in payload:
+            ttl = min(ttl, payload['exp'] - time())
+        if ttl > 0:
+            token_cache.set(digest, payload, ttl)
+
+    return RequestContext(payload['host'], payload['key'],
+                          get_entities_limit(payload))
+
+
+def is_cache_bypassed():
+    """
+    Check whether the caller asked for fresh data
+    with the Cache-Control: no-cache request header.
+    """
+    return 'no-cache' in request.headers.get('Cache-Control', '').lower()
 
 
 def get_json(schema):
@@ -148,24 +237,73 @@ def jsonify_result():
         if not result.get('data'):
             result.pop('data', None)
 
-    return jsonify(result)
+    with span('serialize'):
+        return jsonify(result)
+
+
+def stream_result(sightings, ndjson=False):
+    """
+    Stream sightings as they are extracted in the shape of jsonify_result,
+    with the count written after the docs, or as NDJSON: a line per
+    sighting and a final summary line with the count and the errors.
+    Errors of the first search fail the request as usual,
+    errors of later searches end up in the errors.
+    """
+    sightings = iter(sightings)
+    first = next(sightings, None)
+
+    def generate():
+        count = 0
+        try:
+            for sighting in chain([first] if first else [], sightings):
+                if ndjson:
+                    yield dumps(sighting) + b'\n'
+                else:
+                    yield (b',' if count else
+                           b'{"data":{"sightings":{"docs":[') + dumps(sighting)
+                count += 1
+        except TRFormattedError as error:
+            add_error(error)
+        except Exception:
+            # The response has started, so the error can only be reported
+            # in the document, which is still ended properly.
+            current_app.logger.exception('Streaming sightings failed')
+            add_error(TRFormattedError(UNKNOWN, None))
+
+        errors = g.get('errors', [])
+        if ndjson:
+            yield dumps({'type': 'summary', 'count': count,
+                         'errors': errors}) + b'\n'
+        elif count:
+            yield b'],"count":%d}}' % count
+            if errors:
+                yield b',"errors":' + dumps(errors)
+            yield b'}\n'
+        else:
+            # No sightings key, as with jsonify_result.
+            yield dumps({'errors': errors} if errors else {'data': {}}) \
+                + b'\n'
+
+    mimetype = ('application/x-ndjson' if ndjson
+                else current_app.config['JSONIFY_MIMETYPE'])
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype=mimetype)
 
 
 def add_error(error):
     g.errors = [*g.get('errors', []), error.json]
 
 
-def set_entities_limit(payload):
+def get_entities_limit(payload):
     default = current_app.config['CTR_ENTITIES_LIMIT_DEFAULT']
     try:
         value = int(payload['CTR_ENTITIES_LIMIT'])
-        current_app.config['CTR_ENTITIES_LIMIT'] = value \
-            if value in range(1, default + 1) else default
+        return value if value in range(1, default + 1) else default
     except (ValueError, TypeError, KeyError):
-        current_app.config['CTR_ENTITIES_LIMIT'] = default
+        return default
 
 
-def source_uri(value, params):
-    url = f'https://{current_app.config["HOST"]}'
+def source_uri(host, value, params):
+    url = f'https://{host}'
     path = '/data/app/dataui#/discover'
     return f'{url}{path}?{params.format(value=value)}'
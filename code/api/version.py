@@ -1,4 +1,6 @@
-from flask import Blueprint, jsonify, current_app
+from flask import Blueprint, current_app
+
+from api.json_provider import jsonify
 
 version_api = Blueprint('version', __name__)
 
@@ -1,23 +1,30 @@
 import traceback
 
-from flask import Flask, jsonify
+from flask import Flask
 
+from api.cache import configure_caches
 from api.dashboard import dashboard_api
 from api.enrich import enrich_api
 from api.health import health_api
+from api.metrics import configure_metrics, metrics_api
 from api.version import version_api
 from api.watchdog import watchdog_api
 from api.errors import TRFormattedError
+from api.json_provider import jsonify, JSONEncoder
 from api.utils import jsonify_errors
 
 app = Flask(__name__)
 
 app.url_map.strict_slashes = False
+app.json_encoder = JSONEncoder
 app.config.from_object('config.Config')
+configure_caches(app.config)
+configure_metrics(app)
 
 app.register_blueprint(dashboard_api)
 app.register_blueprint(enrich_api)
 app.register_blueprint(health_api)
+app.register_blueprint(metrics_api)
 app.register_blueprint(version_api)
 app.register_blueprint(watchdog_api)
 
@@ -34,7 +41,8 @@ def handle_error(exception):
     if code != 404:
         app.logger.error(traceback.format_exc())
 
-    response = jsonify(code=str(code), message=message, reason=reason)
+    response = jsonify({'code': str(code), 'message': message,
+                        'reason': reason})
     return response, code
 
 
@@ -0,0 +1,69 @@
+"""
+Microbenchmark of mapping Exabeam hits to sightings and serializing them.
+
+Run from the code folder:
+
+    python benchmarks/sighting_mapping.py
+"""
+import os
+import sys
+from timeit import repeat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from app import app  # noqa: E402
+from api.json_provider import dumps  # noqa: E402
+from api.mapping import Sighting  # noqa: E402
+from api.utils import RequestContext  # noqa: E402
+
+HITS_AMOUNT = 10000
+REPEAT = 5
+
+
+def hit(index):
+    return {
+        '_id': f'AXr{index:012d}',
+        '_source': {
+            'message': f'<134>1 2021-06-01T10:00:00Z host{index} sshd - - '
+                       f'Accepted password for user{index} from 10.0.0.1 '
+                       'port 22 ssh2' * 4,
+            'forwarder': 'exabeam-forwarder',
+            'exa_rawEventTime': '2021-06-01T10:00:00.000Z',
+            'exa_category': 'Authentication',
+            'exa_activity_type': 'authentication',
+            '@timestamp': '2021-06-01T10:00:01.000Z',
+            '@version': '1',
+            '_raw': '',
+            'indexTime': '2021-06-01T10:00:02.000Z',
+            'Product': 'OpenSSH',
+            'Vendor': 'OpenBSD',
+            'host': f'host{index}',
+            'src_ip': '10.0.0.1',
+            'dest_ip': '10.0.0.2',
+            'user': f'user{index}',
+            'event_name': 'ssh-login',
+            'port': 22,
+            'empty': '',
+        }
+    }
+
+
+def main():
+    hits = [hit(index) for index in range(HITS_AMOUNT)]
+    observable = {'type': 'ip', 'value': '10.0.0.1'}
+
+    context = RequestContext('exabeam.example.com', 'key', 100)
+
+    # Sightings are mapped when serialized and the parts of a hit are
+    # kept by its mapping, so every call maps with a new one and dumps.
+    def map_hits():
+        return dumps(Sighting(context).extract_many(hits, observable))
+
+    with app.test_request_context():
+        best = min(repeat(map_hits, number=1, repeat=REPEAT))
+        print(f'{best * 1000:.1f} ms per {HITS_AMOUNT} hits, '
+              f'{HITS_AMOUNT / best:.0f} hits/s')
+
+
+if __name__ == '__main__':
+    main()
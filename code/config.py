@@ -9,7 +9,78 @@ class Config:
                   '<tr-integrations-support@cisco.com>')
     CTR_ENTITIES_LIMIT_DEFAULT = 100
 
+    # Seconds for which public keys of a jwks host are cached, for which
+    # a failed jwks host is not requested again and the minimum interval
+    # between requests caused by an unknown kid.
+    JWKS_CACHE_TTL = 3600
+    JWKS_NEGATIVE_CACHE_TTL = 30
+    JWKS_REFRESH_INTERVAL = 10
+    # Maximum number of seconds for which a verified token is cached,
+    # tokens are never cached beyond their exp claim.
+    JWT_CACHE_TTL = 300
+
+    # Where tokens, search hits, indices and tile data are cached:
+    # 'memory' of every process, or 'sqlite' shared by the processes
+    # of the container through a database in the CACHE_DIR directory,
+    # which is created accessible only to the user of the processes.
+    CACHE_BACKEND = 'memory'
+    CACHE_DIR = '/tmp/tr-exabeam-cache'
+
+    # Whether the time spent in the stages of requests, Exabeam response
+    # times and sizes and cache hits are measured. They are reported in
+    # the Server-Timing header and, for all the processes, at /metrics:
+    # every process writes them to METRICS_DIR at most every
+    # METRICS_FLUSH_INTERVAL seconds.
+    METRICS_ENABLED = False
+    METRICS_DIR = '/tmp/tr-exabeam-metrics'
+    METRICS_FLUSH_INTERVAL = 1
+
     EXABEAM_API_ENDPOINT = 'https://{host}'
+    # Maximum number of simultaneous requests from a single process
+    # to a single Exabeam host.
+    EXABEAM_MAX_CONCURRENT_REQUESTS = 5
+    # Keep-alive connections per Exabeam host kept by each process
+    # and the time in seconds after which unused connections are closed.
+    EXABEAM_POOL_SIZE = EXABEAM_MAX_CONCURRENT_REQUESTS
+    EXABEAM_SESSION_IDLE_TIMEOUT = 60
+    # Whether identical requests made to Exabeam at the same time
+    # with the same credentials share a single response, and the time
+    # in seconds after which a waiting request is made on its own.
+    EXABEAM_REQUEST_COALESCING = True
+    EXABEAM_COALESCING_TIMEOUT = 30
+    # Whether observe and tile data requests are made to Exabeam with
+    # aiohttp, when installed, from an event loop shared by the threads
+    # of a process, and the maximum number of its simultaneous requests
+    # to a single Exabeam host.
+    EXABEAM_ASYNC_CLIENT = False
+    EXABEAM_ASYNC_MAX_CONCURRENT_REQUESTS = 100
+    # Number of observables combined into a single Data Lake search.
+    # Hits are attributed back to the observables they contain,
+    # 1 searches for each observable separately.
+    EXABEAM_SEARCH_BATCH_SIZE = 1
+    # Whether daily indices which don't exist or have no data are
+    # discovered, every given number of seconds, and left out of requests.
+    # Discovery relies on a terms aggregation of the _index field.
+    EXABEAM_INDICES_DISCOVERY = False
+    EXABEAM_INDICES_DISCOVERY_TTL = 60 * 60
+    # Whether hits of all observables are counted with a single request
+    # first, so that only observables with hits are searched for.
+    EXABEAM_TWO_PHASE_SEARCH = False
+    # Number of index ranges a search is split into. The ranges are
+    # searched concurrently and their newest hits are merged.
+    EXABEAM_SEARCH_SHARDS = 1
+    # Fields of logs shown in the data table of sightings, None shows all
+    # fields, and the length log messages are cut to, None keeps them whole.
+    EXABEAM_SOURCE_COLUMNS = None
+    EXABEAM_MESSAGE_MAX_LENGTH = None
+    # Numbers of daily indices searched one after another, newest first,
+    # until enough hits are found, e.g. (1, 6, 23). Indices left over
+    # are searched last. Empty searches all indices at once.
+    EXABEAM_PROGRESSIVE_SEARCH_WINDOWS = ()
+    # Seconds for which search hits of an observable are cached,
+    # observables without hits are cached for a shorter time.
+    SEARCH_CACHE_TTL = 5 * 60
+    SEARCH_NEGATIVE_CACHE_TTL = 60
 
     HUMAN_READABLE_OBSERVABLE_TYPES = {
         'certificate_common_name': 'certificate common name',
@@ -52,6 +123,27 @@ class Config:
         'user_agent': 'user agent',
     }
 
+    # Whether observables of the types below are searched for
+    # only in the fields of logs which may contain them.
+    # Observables of other types are searched for in whole logs.
+    EXABEAM_FIELD_TARGETED_SEARCH = False
+    OBSERVABLE_TYPE_FIELDS = {
+        'domain': ['domain', 'dest_host', 'src_host'],
+        'email': ['email_address', 'sender', 'recipient'],
+        'file_name': ['file_name'],
+        'file_path': ['file_path', 'file_parent'],
+        'hostname': ['host', 'src_host', 'dest_host'],
+        'ip': ['src_ip', 'dest_ip', 'host_ip', 'local_ip', 'remote_ip'],
+        'ipv6': ['src_ip', 'dest_ip', 'host_ip', 'local_ip', 'remote_ip'],
+        'mac_address': ['src_mac', 'dest_mac'],
+        'md5': ['hash_md5'],
+        'process_name': ['process_name', 'parent_process_name'],
+        'sha1': ['hash_sha1'],
+        'sha256': ['hash_sha256'],
+        'url': ['url'],
+        'user': ['user', 'src_user', 'dest_user'],
+    }
+
     URL_PARAMS_FOR_SIGHTING = '_g=(time:(from:now-30d))&_a=(interval:(text:' \
                               'Auto,val:auto),query:(query_string:(default_' \
                               'field:message,query:\'_id:%22{value}%22\')),' \
@@ -82,3 +174,18 @@ class Config:
         'last_7_days': 7,
         'last_30_days': 30
     }
+
+    # Seconds for which tile data of each period is cached and valid.
+    TILE_DATA_CACHE_TTL = {
+        'last_24_hours': 5 * 60,
+        'last_7_days': 30 * 60,
+        'last_30_days': 60 * 60
+    }
+
+    # Whether per day tiles aggregate only the newest TILE_OPEN_INDICES
+    # indices on every request and reuse cached buckets of the others
+    # for TILE_CLOSED_INDEX_CACHE_TTL seconds. It relies on a terms
+    # aggregation of the _index field, as EXABEAM_INDICES_DISCOVERY does.
+    TILE_INCREMENTAL_AGGREGATION = False
+    TILE_OPEN_INDICES = 1
+    TILE_CLOSED_INDEX_CACHE_TTL = 24 * 60 * 60
@@ -0,0 +1,88 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from pytest import fixture
+
+from api.cache import Cache
+from api.client import ExabeamClient
+from api.utils import RequestContext
+from app import app
+
+
+class ExabeamStub:
+    """
+    Local Exabeam API which records the requests made to it
+    and answers them with the status and the data of its handler.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.handler = lambda path, body: (200, {})
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._respond(None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self._respond(json.loads(self.rfile.read(length)))
+
+            def _respond(self, body):
+                stub.requests.append((self.path, body))
+                status, data = stub.handler(self.path, body)
+                content = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self._server.server_port}'
+
+    def __enter__(self):
+        Thread(target=self._server.serve_forever, args=(0.05,),
+               daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@fixture(scope='session')
+def client():
+    app.testing = True
+    with app.test_client() as client:
+        yield client
+
+
+@fixture
+def request_context():
+    return RequestContext('exabeam.example.com', 'key', 100)
+
+
+@fixture
+def exabeam_client(request_context):
+    with app.test_request_context():
+        yield ExabeamClient(request_context)
+
+
+def clear_caches():
+    for cache in Cache.caches.values():
+        cache.clear()
+
+
+@fixture
+def exabeam_stub(monkeypatch):
+    clear_caches()
+    with ExabeamStub() as stub:
+        monkeypatch.setitem(app.config, 'EXABEAM_API_ENDPOINT', stub.url)
+        yield stub
+    clear_caches()
@@ -0,0 +1,157 @@
+import json
+
+from pytest import fixture, importorskip, mark, raises
+
+from api.async_client import AsyncExabeamClient, run
+from api.client import ExabeamClient
+from api.errors import AuthorizationError
+from api.tiles.categories_per_day import CategoriesPerDayTile
+from api.utils import RequestContext
+from app import app
+from tests.unit.conftest import clear_caches
+
+# The async client is used only when aiohttp is installed.
+importorskip('aiohttp')
+
+HITS_PER_INDEX = 10
+
+
+def index_hits(index):
+    # Indices of odd days have no data.
+    if int(index[-1]) % 2:
+        return []
+    return [{'_id': f'{index}-{number}',
+             '_source': {'message': 'log',
+                         'indexTime': f'{index[8:]}T{number:02d}'}}
+            for number in reversed(range(HITS_PER_INDEX))]
+
+
+def handle(path, body):
+    if path == '/dl/api/es/search':
+        indices = body['clusterWithIndices'][0]['indices']
+        hits = sorted((hit for index in indices for hit in index_hits(index)),
+                      key=lambda hit: hit['_source']['indexTime'],
+                      reverse=True)
+        return 200, {'responses': [{'hits': {'hits': hits[:body['size']]}}]}
+
+    indices = body['query']['clusterWithIndices'][0]['indices']
+    aggregation = json.loads(body['aggs'])['indices']
+    buckets = [{'key': index} for index in indices if index_hits(index)]
+    for bucket in buckets:
+        for tile_id, tile_aggregation in aggregation.get('aggs', {}).items():
+            field, = tile_aggregation['aggs']
+            day = int(bucket['key'][-2:]) * 24 * 60 * 60 * 1000
+            bucket[tile_id] = {'buckets': [{
+                'key': day,
+                'doc_count': HITS_PER_INDEX,
+                field: {'buckets': [{'key': 'category',
+                                     'doc_count': HITS_PER_INDEX}]}
+            }]}
+    return 200, {'aggregations': {'indices': {'buckets': buckets}}}
+
+
+@fixture
+def stub(exabeam_stub):
+    exabeam_stub.handler = handle
+    return exabeam_stub
+
+
+def search_both(stub, request_context, observable):
+    """Search with both clients, returning their hits and requests."""
+    with app.test_request_context():
+        hits = ExabeamClient(request_context)._search(observable)
+        requests = sorted(json.dumps(request, sort_keys=True)
+                          for request in stub.requests)
+
+        clear_caches()
+        stub.requests.clear()
+        async_hits = run(
+            AsyncExabeamClient(request_context)._search(observable)
+        )
+        async_requests = sorted(json.dumps(request, sort_keys=True)
+                                for request in stub.requests)
+
+    return (hits, requests), (async_hits, async_requests)
+
+
+@mark.parametrize('config', [
+    {},
+    {'EXABEAM_SEARCH_SHARDS': 4},
+    {'EXABEAM_PROGRESSIVE_SEARCH_WINDOWS': (1, 2)},
+    {'EXABEAM_PROGRESSIVE_SEARCH_WINDOWS': (2,),
+     'EXABEAM_SEARCH_SHARDS': 2},
+    {'EXABEAM_INDICES_DISCOVERY': True, 'EXABEAM_SEARCH_SHARDS': 3},
+])
+def test_async_search_matches_sync_search(stub, request_context,
+                                          monkeypatch, config):
+    for key, value in config.items():
+        monkeypatch.setitem(app.config, key, value)
+
+    sync, async_ = search_both(stub, request_context, ('ip', '1.1.1.1'))
+
+    assert async_ == sync
+    hits = sync[0]
+    assert len(hits) == app.config['CTR_ENTITIES_LIMIT_DEFAULT'] + 1
+    assert hits == sorted(hits, key=lambda hit: hit['_source']['indexTime'],
+                          reverse=True)
+
+
+def test_async_search_stops_after_enough_hits(stub, request_context,
+                                              monkeypatch):
+    monkeypatch.setitem(app.config, 'EXABEAM_PROGRESSIVE_SEARCH_WINDOWS',
+                        (2,))
+    monkeypatch.setitem(app.config, 'CTR_ENTITIES_LIMIT_DEFAULT', 2)
+
+    with app.test_request_context():
+        hits = run(
+            AsyncExabeamClient(request_context)._search(('ip', '1.1.1.1'))
+        )
+
+    assert len(hits) == 3
+    # The first window of two indices holds enough hits for one of them.
+    assert len(stub.requests) == 1
+
+
+def test_async_get_data_many_keeps_order_of_observables(stub,
+                                                        request_context):
+    observables = [{'type': 'ip', 'value': value}
+                   for value in ('1.1.1.1', '2.2.2.2', '1.1.1.1')]
+
+    with app.test_request_context():
+        data = run(
+            AsyncExabeamClient(request_context).get_data_many(observables)
+        )
+
+    assert len(data) == 3
+    assert data[0] == data[1] == data[2]
+    # Repeated observables are searched once.
+    assert len(stub.requests) == 2
+
+
+def test_async_tile_data_matches_sync_tile_data(stub, request_context,
+                                                monkeypatch):
+    monkeypatch.setitem(app.config, 'TILE_INCREMENTAL_AGGREGATION', True)
+
+    with app.test_request_context():
+        tile = CategoriesPerDayTile(request_context)
+        data = tile.visualize_data(ExabeamClient(request_context),
+                                   'last_7_days')
+        clear_caches()
+        async_data = run(tile.visualize_data_async(
+            AsyncExabeamClient(request_context), 'last_7_days'
+        ))
+
+    assert async_data == data
+    assert data['categories_per_day']['buckets']
+
+
+def test_async_client_rejects_key_which_can_not_be_sent(stub):
+    context = RequestContext('exabeam.example.com', 'bad\nkey', 100)
+
+    with app.test_request_context():
+        with raises(AuthorizationError):
+            ExabeamClient(context).health()
+        with raises(AuthorizationError):
+            run(AsyncExabeamClient(context).health())
+
+    assert stub.requests == []
@@ -0,0 +1,53 @@
+import os
+
+from pytest import raises
+
+from api.cache import _Database, SQLiteCache
+
+
+def test_sqlite_cache_round_trips_marshaled_values(tmp_path):
+    database = _Database(str(tmp_path / 'cache'))
+    database.setup()
+    cache = SQLiteCache(database, 'test', maxsize=10)
+    value = ([{'_id': 'a', 'count': 1.5, 'tags': None}] * 100, 100)
+
+    cache.set('key', value, 60)
+    cache.set('indices', {'index-1', 'index-2'}, 60)
+
+    assert cache.get('key') == value
+    assert cache.get('indices') == {'index-1', 'index-2'}
+    assert os.stat(tmp_path / 'cache').st_mode & 0o777 == 0o700
+
+
+def test_sqlite_cache_skips_values_which_can_not_be_marshaled(tmp_path):
+    database = _Database(str(tmp_path / 'cache'))
+    database.setup()
+    cache = SQLiteCache(database, 'test', maxsize=10)
+
+    cache.set('key', object(), 60)
+
+    assert cache.get('key') is None
+
+
+def test_database_refuses_directory_accessible_to_others(tmp_path):
+    directory = tmp_path / 'cache'
+    directory.mkdir(mode=0o777)
+    directory.chmod(0o777)
+
+    with raises(PermissionError):
+        _Database(str(directory)).setup()
+
+
+def test_database_refuses_symbolic_links(tmp_path):
+    directory = tmp_path / 'cache'
+    directory.mkdir(mode=0o700)
+    os.symlink(tmp_path / 'elsewhere', directory / 'cache.sqlite3')
+
+    with raises(OSError):
+        _Database(str(directory)).setup()
+    assert not (tmp_path / 'elsewhere').exists()
+
+    link = tmp_path / 'link'
+    os.symlink(directory, link)
+    with raises(NotADirectoryError):
+        _Database(str(link)).setup()
@@ -0,0 +1,125 @@
+from pytest import fixture
+
+
+def hit(id_, message):
+    return {'_id': id_, '_source': {'message': message}}
+
+
+@fixture
+def search_together(exabeam_client, monkeypatch):
+    separate = []
+
+    def search(observables, hits):
+        monkeypatch.setattr(exabeam_client, '_search_hits',
+                            lambda query, size, indices=None, source=None:
+                            hits)
+        monkeypatch.setattr(exabeam_client, '_search',
+                            lambda observable, size=None:
+                            separate.append(observable) or [])
+        return exabeam_client._search_together(observables), separate
+
+    return search
+
+
+def test_search_together_attributes_hits_by_words(search_together):
+    observables = [('ip', '1.1.1.1'), ('ip', '2.2.2.2')]
+    hits = [hit('1', 'from 1.1.1.1 port 22'), hit('2', 'to 2.2.2.2,'),
+            hit('3', 'src=1.1.1.1')]
+
+    result, separate = search_together(observables, hits)
+
+    assert result == [[hits[0], hits[2]], [hits[1]]]
+    assert separate == []
+
+
+def test_search_together_does_not_split_dotted_words(search_together):
+    observables = [('email', 'bob@x.com'), ('email', 'alice.bob@x.com')]
+    hits = [hit('1', 'mail from alice.bob@x.com'), hit('2', 'to bob@x.com')]
+
+    result, separate = search_together(observables, hits)
+
+    assert result == [[hits[1]], [hits[0]]]
+    assert separate == []
+
+
+def test_search_together_falls_back_for_unmatched_hit(search_together):
+    observables = [('domain', 'example.com'), ('domain', 'example.org')]
+    hits = [hit('1', 'GET example.org'), hit('2', 'GET www.example.com')]
+
+    _, separate = search_together(observables, hits)
+
+    assert separate == observables
+
+
+def test_search_together_attributes_shared_hit_to_all(search_together):
+    observables = [('ip', '1.1.1.1'), ('ip', '2.2.2.2'), ('ip', '3.3.3.3')]
+    hits = [hit('1', '1.1.1.1 -> 2.2.2.2'), hit('2', '3.3.3.3')]
+
+    result, separate = search_together(observables, hits)
+
+    assert result == [[hits[0]], [hits[0]], [hits[1]]]
+    assert separate == []
+
+
+def test_search_together_attributes_by_excluded_fields(search_together):
+    observables = [('ip', '1.1.1.1'), ('ip', '2.2.2.2')]
+    hits = [{'_id': '1', '_source': {'message': '2.2.2.2',
+                                     'Product': '1.1.1.1'}}]
+
+    result, separate = search_together(observables, hits)
+
+    # The fields are left out as by separate searches.
+    assert result == [[hit('1', '2.2.2.2')], [hit('1', '2.2.2.2')]]
+    assert separate == []
+
+
+def test_batch_source_includes_searched_fields(exabeam_client):
+    exabeam_client._field_targeted_search = True
+    exabeam_client._observable_type_fields = {'ip': ['src_ip', 'dest_ip']}
+    exabeam_client._source = {'includes': ['message']}
+
+    assert exabeam_client._batch_source([('ip', '1.1.1.1')]) == {
+        'includes': ['message', 'src_ip', 'dest_ip']
+    }
+
+
+def test_batch_source_does_not_exclude_searched_fields(exabeam_client):
+    exabeam_client._field_targeted_search = True
+    exabeam_client._observable_type_fields = {'ip': ['src_ip'],
+                                              'domain': ['Vendor']}
+    exabeam_client._source = {'excludes': ['_*', 'Product', 'Vendor']}
+
+    assert exabeam_client._batch_source(
+        [('ip', '1.1.1.1'), ('domain', 'example.com')]
+    ) == {'excludes': ['_*', 'Product']}
+
+
+def test_batch_source_returns_all_fields_for_free_text(exabeam_client):
+    exabeam_client._field_targeted_search = True
+    exabeam_client._observable_type_fields = {'ip': ['src_ip']}
+
+    assert exabeam_client._batch_source(
+        [('ip', '1.1.1.1'), ('domain', 'example.com')]
+    ) == {}
+
+
+def test_discover_indices_keeps_all_without_buckets(exabeam_client,
+                                                    monkeypatch):
+    monkeypatch.setattr(
+        exabeam_client, '_request',
+        lambda *args, **kwargs: {'aggregations': {'indices': {'buckets': []}}}
+    )
+
+    assert exabeam_client._discover_indices(['a', 'b']) == {'a', 'b'}
+
+
+def test_discover_indices_keeps_indices_with_buckets(exabeam_client,
+                                                     monkeypatch):
+    monkeypatch.setattr(
+        exabeam_client, '_request',
+        lambda *args, **kwargs: {
+            'aggregations': {'indices': {'buckets': [{'key': 'b'}]}}
+        }
+    )
+
+    assert exabeam_client._discover_indices(['a', 'b']) == {'b'}
@@ -0,0 +1,69 @@
+import json
+
+from pytest import fixture, mark
+
+from api.client import ExabeamClient
+from api.tiles.categories_per_day import CategoriesPerDayTile
+from api.tiles.horizontal_bar_tile import closed_indices_cache
+from app import app
+
+DAY_MS = 24 * 60 * 60 * 1000
+TILE_BUCKETS = [{
+    'key': DAY_MS,
+    'doc_count': 3,
+    'exa_category.keyword': {'buckets': [{'key': 'category', 'doc_count': 3}]}
+}]
+
+
+@fixture
+def incremental(monkeypatch):
+    monkeypatch.setitem(app.config, 'TILE_INCREMENTAL_AGGREGATION', True)
+
+
+def aggregate(indices_aggregations):
+    def handle(path, body):
+        aggregations = json.loads(body['aggs'])
+        if 'indices' in aggregations:
+            return 200, {'aggregations': indices_aggregations}
+        return 200, {'aggregations': {
+            'categories_per_day': {'buckets': TILE_BUCKETS}
+        }}
+    return handle
+
+
+def visualize_data(request_context):
+    with app.test_request_context():
+        return CategoriesPerDayTile(request_context).visualize_data(
+            ExabeamClient(request_context), 'last_7_days'
+        )
+
+
+@mark.parametrize('indices_aggregations', [
+    {},
+    {'indices': {'buckets': []}},
+])
+def test_visualize_data_aggregates_all_without_indices_buckets(
+        exabeam_stub, request_context, incremental, indices_aggregations):
+    exabeam_stub.handler = aggregate(indices_aggregations)
+
+    data = visualize_data(request_context)
+
+    assert data == {'categories_per_day': {'buckets': TILE_BUCKETS}}
+    assert len(exabeam_stub.requests) == 2
+    assert closed_indices_cache.stats()['size'] == 0
+
+
+def test_visualize_data_caches_only_closed_indices_with_buckets(
+        exabeam_stub, request_context, incremental):
+    with app.test_request_context():
+        indices = ExabeamClient(request_context).get_indices(7)
+    exabeam_stub.handler = aggregate({'indices': {'buckets': [
+        {'key': index, 'categories_per_day': {'buckets': TILE_BUCKETS}}
+        for index in indices[:2]
+    ]}})
+
+    data = visualize_data(request_context)
+
+    assert data['categories_per_day']['buckets'][0]['doc_count'] == 6
+    # The newest index is open and the others have no buckets.
+    assert closed_indices_cache.stats()['size'] == 1
@@ -0,0 +1,48 @@
+import flask
+
+from api.json_provider import dumps, loads
+from app import app
+
+
+def test_dumps_matches_flask_for_non_finite_floats():
+    data = loads(b'{"a":NaN,"b":[Infinity,-Infinity],"c":1.5}')
+
+    with app.app_context():
+        expected = flask.json.dumps(data, separators=(',', ':')).encode()
+
+    assert dumps(data) == expected == \
+        b'{"a":NaN,"b":[Infinity,-Infinity],"c":1.5}'
+
+
+def test_dumps_matches_flask_for_non_ascii_and_exponents():
+    data = {'b': 'café', 'a': [1e100, -2.5e-10, 0.1]}
+
+    with app.app_context():
+        expected = flask.json.dumps(data, separators=(',', ':')).encode()
+
+    assert dumps(data) == expected
+
+
+def test_dumps_matches_flask_for_floats_and_escapes():
+    data = [1e-05, -0.00012, 1e16, 1.2345678901234568e+17, 0.0001, 1e15,
+            '\x7f\x00\n\t"\\', ' €😀', 'not a float: 1e5, 0.00001']
+
+    with app.app_context():
+        expected = flask.json.dumps(data, separators=(',', ':')).encode()
+
+    assert dumps(data) == expected
+    assert dumps(1e-05) == b'1e-05'
+
+
+def test_dumps_serializes_objects_once():
+    calls = []
+
+    class Record:
+        def __json__(self):
+            calls.append(self)
+            return {'message': 'café', 'size': 1e-05}
+
+    record = b'{"message":"caf\\u00e9","size":1e-05}'
+
+    assert dumps([Record(), Record()]) == b'[' + record + b',' + record + b']'
+    assert len(calls) == 2
@@ -0,0 +1,60 @@
+from api import metrics
+from api.json_provider import dumps
+from api.mapping import Sighting
+from api.metrics import request_timings
+from app import app
+
+
+def hit(id_):
+    return {'_id': id_, '_source': {'message': id_}}
+
+
+def test_sighting_shares_parts_until_last_use(request_context):
+    shared, single = hit('shared'), hit('single')
+    observables_hits = [[shared, single], [shared], [shared]]
+
+    with app.app_context():
+        mapping = Sighting(request_context, observables_hits)
+        assert mapping._uses == {'shared': 3}
+
+        first = mapping.sighting(shared, {'type': 'ip', 'value': '1'})
+        mapping.sighting(single, {'type': 'ip', 'value': '1'})
+        assert set(mapping._shared) == {'shared'}
+
+        second = mapping.sighting(shared, {'type': 'ip', 'value': '2'})
+        assert second['data'] is first['data']
+
+        third = mapping.sighting(shared, {'type': 'ip', 'value': '3'})
+        assert third['data'] is first['data']
+        assert mapping._shared == mapping._uses == {}
+
+
+def test_sighting_does_not_share_parts_without_hits(request_context):
+    shared = hit('shared')
+
+    with app.app_context():
+        mapping = Sighting(request_context)
+        first = mapping.sighting(shared, {'type': 'ip', 'value': '1'})
+        second = mapping.sighting(shared, {'type': 'ip', 'value': '2'})
+
+    assert first['data'] == second['data']
+    assert first['data'] is not second['data']
+    assert mapping._shared == {}
+
+
+def test_sighting_reports_mapping_time_as_one_span(request_context,
+                                                   monkeypatch):
+    monkeypatch.setattr(metrics, '_enabled', True)
+
+    with app.test_request_context():
+        mapping = Sighting(request_context)
+        records = mapping.extract_many([hit('1'), hit('2')],
+                                       {'type': 'ip', 'value': '1'})
+        assert request_timings() == []
+
+        dumps(records)
+        mapping.observe()
+
+        (stage, duration), = request_timings()
+    assert stage == 'extract'
+    assert duration > 0
@@ -0,0 +1,104 @@
+from threading import Event, Thread
+from time import sleep
+
+from pytest import raises
+
+from api.singleflight import SingleFlight
+
+
+class Calls:
+    """Calls of a function which blocks until it is released."""
+
+    def __init__(self, error=None):
+        self.count = 0
+        self.released = Event()
+        self._error = error
+
+    def __call__(self):
+        self.count += 1
+        self.released.wait(5)
+        if self._error:
+            raise self._error
+        return self.count
+
+
+def call(flight, key, function, outcomes, timeout=None):
+    """Call in a thread, adding the result or the error to outcomes."""
+    def target():
+        try:
+            outcomes.append(flight.do(key, function, timeout))
+        except Exception as error:
+            outcomes.append(error)
+
+    thread = Thread(target=target)
+    thread.start()
+    return thread
+
+
+def start_leader(flight, key, function):
+    results = []
+    thread = call(flight, key, function, results)
+    while key not in flight._calls:
+        sleep(0.001)
+    return thread, results
+
+
+def test_followers_share_result_of_leader():
+    flight = SingleFlight()
+    function = Calls()
+    leader, results = start_leader(flight, 'key', function)
+    outcomes = []
+    followers = [call(flight, 'key', function, outcomes) for _ in range(3)]
+    sleep(0.05)
+
+    function.released.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert function.count == 1
+    assert results == [1]
+    assert outcomes == [1, 1, 1]
+    assert flight._calls == {}
+
+
+def test_followers_get_error_of_leader():
+    flight = SingleFlight()
+    error = ValueError('failed')
+    function = Calls(error)
+    leader, _ = start_leader(flight, 'key', function)
+    outcomes = []
+    followers = [call(flight, 'key', function, outcomes) for _ in range(2)]
+    sleep(0.05)
+
+    function.released.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert function.count == 1
+    assert outcomes == [error, error]
+    assert flight._calls == {}
+
+
+def test_follower_calls_function_itself_after_timeout():
+    flight = SingleFlight()
+    function = Calls()
+    leader, results = start_leader(flight, 'key', function)
+
+    assert flight.do('key', lambda: 'own', timeout=0.01) == 'own'
+    function.released.set()
+    leader.join()
+    assert results == [1]
+
+
+def test_calls_with_other_keys_are_not_coalesced():
+    flight = SingleFlight()
+    function = Calls()
+    leader, _ = start_leader(flight, 'key', function)
+
+    assert flight.do('other', lambda: 'other') == 'other'
+    function.released.set()
+    leader.join()
+
+    with raises(KeyError):
+        flight.do('key', lambda: {}['missing'])
+    assert flight._calls == {}
@@ -0,0 +1,124 @@
+from time import monotonic, time
+
+from flask import g
+from pytest import fixture
+
+from api import cache, utils
+from api.errors import TRFormattedError
+from api.json_provider import loads
+from api.utils import get_jwt, jsonify_result, stream_result, token_cache
+from app import app
+
+
+def sightings(*items, error=None):
+    yield from items
+    if error:
+        raise error
+
+
+def test_stream_result_without_sightings_matches_jsonify_result():
+    with app.test_request_context():
+        streamed = stream_result(sightings()).get_data()
+        assert streamed == jsonify_result().get_data() == b'{"data":{}}\n'
+
+
+def test_stream_result_without_sightings_has_only_errors():
+    with app.test_request_context():
+        g.errors = [{'type': 'fatal', 'code': 'unknown', 'message': 'x'}]
+        streamed = stream_result(sightings()).get_data()
+        assert streamed == jsonify_result().get_data()
+        assert 'data' not in loads(streamed)
+
+
+def test_stream_result_matches_jsonify_result():
+    error = TRFormattedError('code', 'message')
+    with app.test_request_context():
+        streamed = stream_result(sightings({'id': 1}, {'id': 2},
+                                           error=error)).get_data()
+        g.sightings = [{'id': 1}, {'id': 2}]
+        assert loads(streamed) == loads(jsonify_result().get_data())
+
+
+def test_stream_result_ends_document_on_unexpected_error():
+    with app.test_request_context():
+        streamed = stream_result(sightings({'id': 1},
+                                           error=ValueError())).get_data()
+
+    assert loads(streamed) == {
+        'data': {'sightings': {'count': 1, 'docs': [{'id': 1}]}},
+        'errors': [{'type': 'fatal', 'code': 'unknown',
+                    'message': 'Something went wrong.'}]
+    }
+
+
+def test_stream_result_ndjson_ends_with_summary_on_unexpected_error():
+    with app.test_request_context():
+        streamed = stream_result(sightings({'id': 1}, error=ValueError()),
+                                 ndjson=True).get_data()
+
+    lines = [loads(line) for line in streamed.splitlines()]
+    assert lines[0] == {'id': 1}
+    assert lines[-1]['type'] == 'summary'
+    assert lines[-1]['count'] == 1
+    assert lines[-1]['errors'][0]['code'] == 'unknown'
+
+
+@fixture
+def verified(monkeypatch):
+    """Audiences tokens are verified for, with payloads of verify_jwt."""
+    audiences = []
+    payload = {'host': 'exabeam.example.com', 'key': 'key'}
+
+    def verify_jwt(token, aud):
+        audiences.append(aud)
+        return dict(payload)
+
+    token_cache.clear()
+    monkeypatch.setattr(utils, 'verify_jwt', verify_jwt)
+    yield audiences, payload
+    token_cache.clear()
+
+
+def jwt_context(token='token', base_url='https://relay.example.com'):
+    with app.test_request_context(
+            base_url=base_url, headers={'Authorization': f'Bearer {token}'}
+    ):
+        return get_jwt()
+
+
+def test_get_jwt_caches_verified_tokens_per_audience(verified):
+    audiences, _ = verified
+
+    context = jwt_context()
+    assert jwt_context() == context
+    jwt_context(base_url='https://other.example.com')
+    jwt_context('other')
+
+    assert audiences == ['https://relay.example.com',
+                         'https://other.example.com',
+                         'https://relay.example.com']
+    assert context.host == 'exabeam.example.com'
+
+
+def test_get_jwt_caches_tokens_until_exp(verified, monkeypatch):
+    audiences, payload = verified
+    payload['exp'] = time() + 10
+
+    jwt_context()
+    jwt_context()
+    assert len(audiences) == 1
+
+    later = monotonic() + 11
+    monkeypatch.setattr(cache, 'monotonic', lambda: later)
+    jwt_context()
+    assert len(audiences) == 2
+
+
+def test_get_jwt_does_not_cache_expired_tokens(verified):
+    audiences, payload = verified
+    payload['exp'] = time() - 1
+
+    jwt_context()
+    jwt_context()
+
+    assert len(audiences) == 2